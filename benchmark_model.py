@@ -0,0 +1,135 @@
+"""
+Benchmark the train step of the networks of train.py on synthetic 1024x1024 batches, without the input pipeline.
+Each configuration (network, with/without XLA, precision, with/without gradient checkpointing) runs in its own
+process, so the peak memory and compilation of one configuration do not carry over to the next. Takes the same command
+line arguments as train.py (batch size, number of classes, gradient accumulation, ...), ex:
+    python benchmark_model.py --batch_size 4 --accum_steps 1 --networks unet agunet --xla_modes 0 1
+    python benchmark_model.py --gpu "" --batch_size 2 --networks agunet --precisions float32 mixed_bfloat16
+    python benchmark_model.py --batch_size 16 --accum_steps 1 --networks agunet --checkpointing_modes 0 1
+Reports the time per train step (after the first steps, which include compilation) and the peak memory of the GPU, or
+the peak resident memory of the process when training on CPU. With several checkpointing modes, the memory saved and
+the extra time per step of gradient checkpointing are reported as well.
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import tensorflow as tf
+from tensorflow.keras import mixed_precision
+from gradient_accumulator import GradientAccumulateModel
+from train import get_parser, create_model, compile_model, precision_policy
+
+
+IMG_SIZE = 1024
+
+
+def run(ret):
+    """
+    Time the train step of a single configuration
+    :return: ms per step and peak memory in MB
+    """
+    model = create_model(ret, IMG_SIZE)
+    if ret.accum_steps > 1:
+        model = GradientAccumulateModel(
+            accum_steps=ret.accum_steps, mixed_precision=precision_policy(ret) == "mixed_float16",
+            inputs=model.input, outputs=model.outputs
+        )
+    class_names = ["epithelium"] if ret.nbr_classes == 2 else ["invasive", "benign", "insitu"]
+    compile_model(ret, model, class_names)
+
+    x = tf.random.uniform((ret.batch_size, IMG_SIZE, IMG_SIZE, 3))
+    y = tf.one_hot(tf.random.uniform((ret.batch_size, IMG_SIZE, IMG_SIZE), maxval=ret.nbr_classes, dtype=tf.int32),
+                   ret.nbr_classes)
+    for _ in range(ret.warmup):
+        model.train_on_batch(x, y)
+    start = time.perf_counter()
+    for _ in range(ret.steps):
+        model.train_on_batch(x, y)  # returns the loss, waits for the step to finish
+    seconds = (time.perf_counter() - start) / ret.steps
+
+    if tf.config.list_physical_devices("GPU"):
+        peak = tf.config.experimental.get_memory_info("GPU:0")["peak"] / 2 ** 20
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # KB on Linux
+    return 1000 * seconds, peak
+
+
+def main(ret, argv):
+    precisions = ret.precisions or [precision_policy(ret)]
+    checkpointing_modes = ret.checkpointing_modes or [ret.checkpointing]
+    print("network".ljust(10) + "xla".rjust(6) + "precision".rjust(16) + "ckpt".rjust(6) + "ms/step".rjust(12) +
+          "patches/s".rjust(12) + "peak MB".rjust(12))
+    results = {}
+    for network in ret.networks:
+        for xla in ret.xla_modes:
+            for precision in precisions:
+                for checkpointing in checkpointing_modes:
+                    if xla and network != "agunet":
+                        continue  # not supported, see create_model
+                    # one process per configuration, arguments given last override the ones of argv
+                    output = subprocess.run([sys.executable, os.path.abspath(__file__)] + argv +
+                                            ["--network", network, "--xla", str(xla), "--precision", precision,
+                                             "--mixed_precision", "0", "--checkpointing", str(checkpointing),
+                                             "--single", "1"],
+                                            stdout=subprocess.PIPE, universal_newlines=True)
+                    lines = [x for x in output.stdout.splitlines() if x.startswith("RESULT ")]
+                    row = network.ljust(10) + str(xla).rjust(6) + precision.rjust(16) + str(checkpointing).rjust(6)
+                    if output.returncode != 0 or not lines:
+                        # ex: out of memory
+                        print(row + "failed".rjust(12))
+                        continue
+                    result = json.loads(lines[-1][len("RESULT "):])
+                    results[(network, xla, precision, checkpointing)] = result
+                    print(row + ("%.1f" % result["ms"]).rjust(12) +
+                          ("%.2f" % (1000 * ret.batch_size / result["ms"])).rjust(12) +
+                          ("%.0f" % result["peak"]).rjust(12))
+
+    # memory saved versus extra compute of gradient checkpointing, for each configuration benchmarked both ways
+    compared = [(config, results[config + (1,)]) for config in sorted(set(x[:-1] for x in results))
+                if config + (0,) in results and config + (1,) in results]
+    if compared:
+        print("\ngradient checkpointing:")
+        print("network".ljust(10) + "xla".rjust(6) + "precision".rjust(16) + "memory saved".rjust(14) +
+              "extra time".rjust(12))
+        for config, result in compared:
+            baseline = results[config + (0,)]
+            print(config[0].ljust(10) + str(config[1]).rjust(6) + config[2].rjust(16) +
+                  ("%.0f%%" % (100 * (1 - result["peak"] / baseline["peak"]))).rjust(14) +
+                  ("%.0f%%" % (100 * (result["ms"] / baseline["ms"] - 1))).rjust(12))
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--networks', type=str, nargs='*', default=["unet", "agunet"],
+                        help="networks to benchmark.")
+    parser.add_argument('--xla_modes', type=int, nargs='*', default=[0, 1],
+                        help="benchmark without (0) and/or with (1) XLA.")
+    parser.add_argument('--precisions', type=str, nargs='*', default=None,
+                        help="mixed precision policies to benchmark (ex: float32 mixed_bfloat16). The one given by "
+                             "--precision/--mixed_precision if not set.")
+    parser.add_argument('--checkpointing_modes', type=int, nargs='*', default=None,
+                        help="benchmark without (0) and/or with (1) gradient checkpointing. The one given by "
+                             "--checkpointing if not set.")
+    parser.add_argument('--steps', type=int, nargs='?', default=20,
+                        help="number of train steps to time.")
+    parser.add_argument('--warmup', type=int, nargs='?', default=3,
+                        help="number of train steps before timing (tracing and XLA compilation).")
+    parser.add_argument('--single', type=int, nargs='?', default=0,
+                        help="benchmark the configuration given by --network, --xla, --precision and "
+                             "--checkpointing in this process.")
+    ret = parser.parse_known_args(sys.argv[1:])[0]
+
+    os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'true'  # peak memory used, not the memory reserved by TensorFlow
+    os.environ["CUDA_VISIBLE_DEVICES"] = ret.gpu
+
+    if ret.single:
+        if ret.seed:
+            tf.random.set_seed(ret.seed)
+        if precision_policy(ret) != "float32":
+            mixed_precision.set_global_policy(precision_policy(ret))
+        ms, peak = run(ret)
+        print("RESULT " + json.dumps({"ms": ms, "peak": peak}))
+    else:
+        main(ret, sys.argv[1:])
@@ -0,0 +1,73 @@
+"""
+Benchmark the train input pipeline of train.py without building or training a model. The pipeline is created from
+the same command line arguments as train.py (reader, sampler, augmentations, batching and prefetch), ex:
+    python benchmark_pipeline.py --dataset_path /data/tma/ --dataset_path_wsi /data/wsi/ --proc 8 --flip 1 --rot 1
+Reports batches/sec and CPU utilization of the full pipeline, and the cost of each stage, measured as the increase
+in time per batch when the pipeline is cut after that stage instead of the previous one. All stages are timed with the
+same patch caches and loader processes (see create_pipeline_resources), so that later stages are not timed with cold
+caches and starting processes.
+"""
+import os
+import sys
+import time
+from train import get_parser, create_datasets, create_pipeline_resources, PIPELINE_STAGES
+
+
+def cpu_time(loader=None):
+    """
+    :return: user and system CPU time of this process, its finished children and the live loader processes
+    """
+    times = os.times()
+    seconds = times.user + times.system + times.children_user + times.children_system
+    return seconds + (loader.cpu_time() if loader is not None else 0.)
+
+
+def time_batches(ds, nbr_batches, warmup, elements_per_batch, loader=None):
+    """
+    :param loader: source.loader.SharedMemoryLoader reading the patches, its processes are counted in the CPU time
+    :return: seconds per batch and CPU utilization (in cores) while timing
+    """
+    iterator = iter(ds)
+    for _ in range(warmup * elements_per_batch):
+        next(iterator)
+    start_cpu = cpu_time(loader)
+    start = time.perf_counter()
+    for _ in range(nbr_batches * elements_per_batch):
+        next(iterator)
+    wall = time.perf_counter() - start
+    cpu = cpu_time(loader) - start_cpu
+    return wall / nbr_batches, cpu / wall
+
+
+def main(ret):
+    stages = PIPELINE_STAGES if ret.stages else PIPELINE_STAGES[-1:]
+    print("stage".ljust(10) + "ms/batch".rjust(12) + "stage ms".rjust(12) + "batches/s".rjust(12) +
+          "CPU cores".rjust(12) + "CPU %".rjust(8))
+    # caches and loader processes shared by the pipelines of all stages
+    resources = create_pipeline_resources(ret)
+    previous = 0.
+    for stage in stages:
+        ds_train = create_datasets(ret, stage=stage, resources=resources)[0]
+        # single patches before batching, except with batched augmentation where augment comes after batching
+        per_patch = stage in ["sample", "read"] or (stage == "augment" and not ret.batch_aug)
+        seconds, cores = time_batches(ds_train, ret.steps, ret.warmup, ret.batch_size if per_patch else 1,
+                                      resources["loader"])
+        print(stage.ljust(10) + ("%.1f" % (1000 * seconds)).rjust(12) +
+              ("%.1f" % (1000 * (seconds - previous))).rjust(12) + ("%.2f" % (1 / seconds)).rjust(12) +
+              ("%.2f" % cores).rjust(12) + ("%.0f" % (100 * cores / os.cpu_count())).rjust(8))
+        previous = seconds
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--steps', type=int, nargs='?', default=50,
+                        help="number of batches to time.")
+    parser.add_argument('--warmup', type=int, nargs='?', default=5,
+                        help="number of batches to draw before timing (fills buffers and caches).")
+    parser.add_argument('--stages', type=int, nargs='?', default=1,
+                        help="also time the pipeline cut after each stage, to get the cost of each stage.")
+    ret = parser.parse_known_args(sys.argv[1:])[0]
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""  # the input pipeline runs on CPU
+
+    main(ret)
@@ -0,0 +1,28 @@
+"""
+Script to convert a patch dataset (created with create_data_tma.py or create_data_wsi.py) to TFRecords, which are
+decoded natively by tf.data in train.py (--records 1)
+The class folder structure is kept, ex: dataset/ds_train/invasive/ -> dataset/records/ds_train/invasive/
+"""
+from argparse import ArgumentParser
+import sys
+from source.records import export_directory
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--dataset_path', type=str,
+                        help="path to dataset, containing ds_train/ and ds_val/.")
+    parser.add_argument('--output_path', type=str, nargs='?', default=None,
+                        help="where to store the TFRecords. Default is <dataset_path>/records/.")
+    parser.add_argument('--patches_per_file', type=int, nargs='?', default=256,
+                        help="number of patches in each TFRecord file.")
+    ret = parser.parse_known_args(sys.argv[1:])[0]
+
+    dataset_path = ret.dataset_path.rstrip("/") + "/"
+    output_path = dataset_path + "records/" if ret.output_path is None else ret.output_path.rstrip("/") + "/"
+
+    for set_name in ["ds_train", "ds_val"]:
+        print("Exporting", set_name, "...")
+        export_directory(dataset_path + set_name + "/", output_path + set_name + "/", ret.patches_per_file)
+
+    print("Finished!")
@@ -15,6 +15,9 @@ from datetime import datetime, date
 import multiprocessing as mp
 from skimage.exposure import equalize_hist
 from skimage.morphology import remove_small_holes, binary_dilation, disk
+from source.shards import ShardWriter
+from source.cores import CORE_SUFFIX
+from source.manifest import PatchManifest, MANIFEST_NAME, count_class_pixels
 
 
 def minmax(x):
@@ -169,6 +172,13 @@ def create_datasets(he_path, ck_path, mask_path, annot_path, remove_path, triple
     count_inSitu = 0
     count = 0
 
+    shard_writers = {}  # one writer per class folder, only used when storing patches in shards
+
+    manifest = None
+    if write_manifest:
+        os.makedirs(dataset_path, exist_ok=True)
+        manifest = PatchManifest(dataset_path + MANIFEST_NAME)
+
     for he_counter in range(len(he_tmas)):
         for ck_counter in range(len(ck_tmas)):
 
@@ -334,6 +344,38 @@ def create_datasets(he_path, ck_path, mask_path, annot_path, remove_path, triple
                     dab_core_padded_shifted[healthy_ep == 1] = 0
                     dab_core_padded_shifted[in_situ_ep == 1] = 0
 
+                if storage == "cores":
+                    # store the registered core once as uint8 label map, patches are cropped from it at train time
+                    # (see source.cores.random_core_crop). Patch-level registration below is not done for cores
+                    gt_core = np.zeros(dab_core_padded_shifted.shape, dtype="uint8")
+                    gt_core[dab_core_padded_shifted.astype(bool)] = 1
+                    if class_ == "multiclass":
+                        gt_core[healthy_ep.astype(bool)] = 2
+                        gt_core[in_situ_ep.astype(bool)] = 3
+                        add_to_path = 'inSitu/' if np.any(in_situ_ep) else ('benign/' if np.any(healthy_ep) else
+                                                                             'invasive/')
+                    else:
+                        add_to_path = ""
+
+                    intensity_away_from_white_thresh = 40
+                    he_tissue = (np.mean(he_tma_padded, axis=-1) < 255 - intensity_away_from_white_thresh)
+                    he_tissue_ = np.sum(he_tissue) / (he_tissue.shape[0] * he_tissue.shape[1])
+
+                    os.makedirs(dataset_path + set_name + "/" + add_to_path, exist_ok=True)
+                    core_path = dataset_path + set_name + "/" + add_to_path + "wsi_" + str(wsi_idx) + "_" + \
+                        str(tma_idx) + "_" + str(file_front) + "_" + "_" + str(id_) + "_" + str(triplet_nbr) + \
+                        CORE_SUFFIX
+                    with h5py.File(core_path, "w") as f:
+                        f.create_dataset(name="input", data=he_tma_padded.astype("uint8"))
+                        f.create_dataset(name="output", data=gt_core)
+
+                    if manifest is not None:
+                        manifest.add(core_path, set_name, class_name=add_to_path, source="tma", cohort=file_front,
+                                     tissue=he_tissue_, class_pixels=count_class_pixels(gt_core, 4 if class_ ==
+                                                                                        "multiclass" else 2))
+                    tma_idx += 1
+                    continue
+
                 # @TODO: does fast.PatchGenerator pad or stretch image if not "enough"?
                 data = [he_tma_padded, ck_tma_padded_shifted, dab_core_padded_shifted, healthy_ep, in_situ_ep]
                 data_fast = [fast.Image.createFromArray(curr) for curr in data]
@@ -442,23 +484,40 @@ def create_datasets(he_path, ck_path, mask_path, annot_path, remove_path, triple
                         add_to_path = 'invasive/'
                         count_invasive += 1
 
-                    # create folder if not exists
-                    if class_ == "multiclass":
+                    patch_name = "wsi_" + str(wsi_idx) + "_" + str(tma_idx) + "_" + str(patch_idx) + "_" + \
+                                 str(file_front) + "_" + "_" + str(id_) + "_" + str(triplet_nbr)
+                    if class_ == "singleclass":
+                        add_to_path = ""
+
+                    if class_ not in ["multiclass", "singleclass"]:
+                        raise ValueError("Unknown class_ variable chosen:", class_)
+
+                    # store gt either as one-hot or as uint8 label map with one class index per pixel
+                    if gt_format == "labelmap":
+                        gt_out = np.argmax(gt_one_hot, axis=-1).astype("uint8")
+                    elif class_ == "multiclass":
+                        gt_out = gt_one_hot.astype("float32")
+                    else:
+                        gt_out = gt_one_hot.astype("uint8")
+
+                    if storage == "shards":
+                        if add_to_path not in shard_writers:
+                            shard_writers[add_to_path] = ShardWriter(dataset_path + set_name + "/" + add_to_path +
+                                                                     "wsi_" + str(wsi_idx), shard_size=shard_size)
+                        patch_path = shard_writers[add_to_path].write(
+                            patch_he.astype("uint8"), gt_out, name=patch_name, class_name=add_to_path.strip("/"),
+                            coords=(wsi_idx, tma_idx, patch_idx, triplet_nbr))
+                    else:
+                        # create folder if not exists
                         os.makedirs(dataset_path + set_name + "/" + add_to_path, exist_ok=True)
-                        with h5py.File(dataset_path + set_name + "/" + add_to_path + "/" + "wsi_" + str(wsi_idx) +
-                                       "_" + str(tma_idx) + "_" + str(patch_idx) + "_" + str(file_front) + "_" +
-                                       "_" + str(id_) + "_" + str(triplet_nbr) + ".h5", "w") as f:
+                        patch_path = dataset_path + set_name + "/" + add_to_path + patch_name + ".h5"
+                        with h5py.File(patch_path, "w") as f:
                             f.create_dataset(name="input", data=patch_he.astype("uint8"))
-                            f.create_dataset(name="output", data=gt_one_hot.astype("float32"))
-                    elif class_ == "singleclass":
-                        os.makedirs(dataset_path + set_name + "/", exist_ok=True)
-                        with h5py.File(dataset_path + set_name + "/" + "wsi_" + str(wsi_idx) + "_" + str(tma_idx) + "_"
-                                       + str(patch_idx) + "_" + str(file_front) + "_" +
-                                       "_" + str(id_) + "_" + str(triplet_nbr) + ".h5", "w") as f:
-                            f.create_dataset(name="input", data=patch_he.astype("uint8"))
-                            f.create_dataset(name="output", data=gt_one_hot.astype("uint8"))
-                    else:
-                        raise ValueError("Unknown class_ variable chosen:", class_)
+                            f.create_dataset(name="output", data=gt_out)
+
+                    if manifest is not None:
+                        manifest.add(patch_path, set_name, class_name=add_to_path, source="tma", cohort=file_front,
+                                     tissue=he_tissue_, class_pixels=count_class_pixels(gt_one_hot))
 
                 # delete streamers and stuff to potentially avoid threading issues in FAST
                 del data_fast, generators, streamers
@@ -466,6 +525,11 @@ def create_datasets(he_path, ck_path, mask_path, annot_path, remove_path, triple
                 tma_idx += 1
 
 
+    for writer in shard_writers.values():
+        writer.close()
+    if manifest is not None:
+        manifest.close()
+
     he_tmas.clear()
     ck_tmas.clear()
     del he_tmas, ck_tmas
@@ -500,6 +564,11 @@ if __name__ == "__main__":
     overlap = 0.25
     class_ = "multiclass"  # singleclass
     skip_percentage = 0.25
+    storage = "files"  # "files": one .h5 file per patch, "shards": many patches per .shard.h5 file,
+    # "cores": one .core.h5 file per registered TMA core, random patches are cropped from cores when training
+    shard_size = 256  # number of patches per shard
+    gt_format = "onehot"  # "onehot": float32 one-hot, "labelmap": uint8 label map with class indices (16x smaller)
+    write_manifest = True  # add all patches to <dataset_path>/manifest.sqlite, used by train.py --manifests
 
     HE_CK_dir_path = '/path/to/images/'
 
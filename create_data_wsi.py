@@ -14,6 +14,8 @@ import matplotlib.pyplot as plt
 import os
 from skimage.exposure import equalize_hist
 import multiprocessing as mp
+from source.shards import ShardWriter
+from source.manifest import PatchManifest, MANIFEST_NAME, count_class_pixels
 
 
 def create_datasets_wrapper(some_inputs_):
@@ -212,6 +214,13 @@ def create_dataset(he_path, ck_path, roi_annot_path, annot_path, dab_path, datas
         for curr in data_fast]
     streamers = [fast.DataStream(curr) for curr in generators]
 
+    shard_writers = {}  # one writer per class folder, only used when storing patches in shards
+
+    manifest = None
+    if write_manifest:
+        os.makedirs(dataset_path, exist_ok=True)
+        manifest = PatchManifest(dataset_path + MANIFEST_NAME)
+
     for patch_idx, (patch_he_, patch_ck_, patch_healthy, patch_in_situ, patch_invasive,
                     patch_roi_annot_) in enumerate(zip(*streamers)):  # get error here sometimes, why?
         try:
@@ -304,12 +313,42 @@ def create_dataset(he_path, ck_path, roi_annot_path, annot_path, dab_path, datas
         else:
             add_to_path = 'invasive/'
 
-        # create folder if not exists
-        os.makedirs(dataset_path + set_name + add_to_path, exist_ok=True)
-        with h5py.File(dataset_path + set_name + add_to_path + "wsi_" + str(wsi_idx) + "_" + str(square_idx) + "_" +
-                       str(patch_idx) + ".h5", "w") as f:
-            f.create_dataset(name="input", data=patch_he_.astype("uint8"))
-            f.create_dataset(name="output", data=gt_one_hot.astype("float32"))
+        # store gt either as one-hot or as uint8 label map with one class index per pixel
+        if gt_format == "labelmap":
+            gt_out = np.argmax(gt_one_hot, axis=-1).astype("uint8")
+        else:
+            gt_out = gt_one_hot.astype("float32")
+
+        # fraction of patch covered by tissue, stored in the manifest
+        intensity_away_from_white_thresh = 40
+        he_tissue = (np.mean(patch_he_, axis=-1) < 255 - intensity_away_from_white_thresh).astype("uint8")
+        he_tissue_ = np.sum(he_tissue) / (he_tissue.shape[0] * he_tissue.shape[1])
+
+        patch_name = "wsi_" + str(wsi_idx) + "_" + str(square_idx) + "_" + str(patch_idx)
+        if storage == "shards":
+            if add_to_path not in shard_writers:
+                shard_writers[add_to_path] = ShardWriter(dataset_path + set_name + add_to_path + "wsi_" +
+                                                         str(wsi_idx) + "_" + str(square_idx), shard_size=shard_size)
+            patch_path = shard_writers[add_to_path].write(patch_he_.astype("uint8"), gt_out, name=patch_name,
+                                                          class_name=add_to_path.strip("/"),
+                                                          coords=(wsi_idx, square_idx, patch_idx))
+        else:
+            # create folder if not exists
+            os.makedirs(dataset_path + set_name + add_to_path, exist_ok=True)
+            patch_path = dataset_path + set_name + add_to_path + patch_name + ".h5"
+            with h5py.File(patch_path, "w") as f:
+                f.create_dataset(name="input", data=patch_he_.astype("uint8"))
+                f.create_dataset(name="output", data=gt_out)
+
+        if manifest is not None:
+            manifest.add(patch_path, set_name, class_name=add_to_path, source="wsi",
+                         cohort=os.path.basename(he_path).split(".vsi")[0], tissue=he_tissue_,
+                         class_pixels=count_class_pixels(gt_one_hot))
+
+    for writer in shard_writers.values():
+        writer.close()
+    if manifest is not None:
+        manifest.close()
 
     # delete streamers and stuff to potentially avoid threading issues in FAST
     del data_fast, generators, streamers, data
@@ -331,6 +370,10 @@ if __name__ == "__main__":
     overlap = 0.25  # overlap when creating patches
     tissue_level = 0.25  # patches with less tissue will be skipped
     wsi_idx = 0
+    storage = "files"  # "files": one .h5 file per patch, "shards": many patches per .shard.h5 file
+    shard_size = 256  # number of patches per shard
+    gt_format = "onehot"  # "onehot": float32 one-hot, "labelmap": uint8 label map with class indices (16x smaller)
+    write_manifest = True  # add all patches to <dataset_path>/manifest.sqlite, used by train.py --manifests
 
     curr_date = "".join(date.today().strftime("%d/%m").split("/")) + date.today().strftime("%Y")[2:]
     curr_time = "".join(str(datetime.now()).split(" ")[1].split(".")[0].split(":"))
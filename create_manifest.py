@@ -0,0 +1,50 @@
+"""
+Script to create a patch manifest (manifest.sqlite) for a dataset that was created without one, by listing the
+dataset folders once. Newly created datasets get a manifest from create_data_tma.py/create_data_wsi.py directly.
+"""
+from argparse import ArgumentParser
+import os
+import sys
+import numpy as np
+from tqdm import tqdm
+from source.manifest import PatchManifest, MANIFEST_NAME, count_class_pixels
+from source.utils import list_patch_paths, read_patch
+
+
+def patch_stats(path, nb_classes):
+    # same threshold as used when creating the datasets
+    intensity_away_from_white_thresh = 40
+    image, gt = read_patch(path)
+    he_tissue = (np.mean(image, axis=-1) < 255 - intensity_away_from_white_thresh).astype("uint8")
+    return np.sum(he_tissue) / (he_tissue.shape[0] * he_tissue.shape[1]), count_class_pixels(gt, nb_classes)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--dataset_path', type=str,
+                        help="path to dataset, containing ds_train/ and ds_val/.")
+    parser.add_argument('--source', type=str, nargs='?', default="tma",
+                        help="source of patches, ex: tma or wsi.")
+    parser.add_argument('--cohort', type=str, nargs='?', default="",
+                        help="cohort of patches, if known.")
+    parser.add_argument('--tissue', type=int, nargs='?', default=0,
+                        help="compute tissue fraction and class pixel counts of each patch (reads all patches).")
+    parser.add_argument('--nb_classes', type=int, nargs='?', default=4,
+                        help="number of labels (including background) to count pixels of, for patches stored as "
+                             "label maps.")
+    ret = parser.parse_known_args(sys.argv[1:])[0]
+
+    dataset_path = ret.dataset_path.rstrip("/") + "/"
+    manifest = PatchManifest(dataset_path + MANIFEST_NAME)
+
+    for set_name in ["ds_train", "ds_val"]:
+        set_path = dataset_path + set_name + "/"
+        class_dirs = [x + "/" for x in os.listdir(set_path) if os.path.isdir(set_path + x)]
+        for class_dir in (class_dirs if class_dirs else [""]):
+            for path in tqdm(list_patch_paths(set_path + class_dir), set_name + "/" + class_dir):
+                tissue, class_pixels = patch_stats(path, ret.nb_classes) if ret.tissue else (None, None)
+                manifest.add(path, set_name, class_name=class_dir, source=ret.source, cohort=ret.cohort,
+                             tissue=tissue, class_pixels=class_pixels)
+
+    manifest.close()
+    print("Finished!")
@@ -0,0 +1,44 @@
+"""
+Start a tf.data service dispatcher or worker, to run the train input pipeline of train.py (reading, augmentation,
+batching) on other (CPU) nodes than the one training the model. Start one dispatcher and any number of workers, then
+train with --data_service pointing to the dispatcher, ex:
+    python data_service.py dispatcher --port 5050
+    python data_service.py worker --dispatcher_address node01:5050 --port 5051
+    python train.py --records 1 --data_service grpc://node01:5050
+Workers read the patches themselves, so the datasets must be available at the same paths on all worker nodes. All
+processes can be started on the same machine for testing.
+"""
+from argparse import ArgumentParser
+import os
+import sys
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('role', type=str, choices=["dispatcher", "worker"],
+                        help="start a dispatcher or a worker.")
+    parser.add_argument('--port', type=int, nargs='?', default=5050,
+                        help="port to serve on.")
+    parser.add_argument('--dispatcher_address', type=str, nargs='?', default="localhost:5050",
+                        help="host:port of the dispatcher (workers only).")
+    parser.add_argument('--worker_address', type=str, nargs='?', default=None,
+                        help="host:port the dispatcher and clients reach this worker on (workers only). Default is "
+                             "localhost:<port>, set it when workers run on other nodes than the trainer.")
+    parser.add_argument('--work_dir', type=str, nargs='?', default=None,
+                        help="directory where the dispatcher stores its state, to recover after a restart "
+                             "(dispatcher only).")
+    ret = parser.parse_known_args(sys.argv[1:])[0]
+
+    os.environ["CUDA_VISIBLE_DEVICES"] = ""  # the input pipeline runs on CPU
+
+    import tensorflow as tf
+
+    if ret.role == "dispatcher":
+        server = tf.data.experimental.service.DispatchServer(tf.data.experimental.service.DispatcherConfig(
+            port=ret.port, work_dir=ret.work_dir, fault_tolerant_mode=ret.work_dir is not None))
+    else:
+        worker_address = ret.worker_address if ret.worker_address else "localhost:" + str(ret.port)
+        server = tf.data.experimental.service.WorkerServer(tf.data.experimental.service.WorkerConfig(
+            dispatcher_address=ret.dispatcher_address, worker_address=worker_address, port=ret.port))
+    print("Started tf.data service " + ret.role + " on port " + str(ret.port))
+    server.join()
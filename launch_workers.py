@@ -0,0 +1,54 @@
+"""
+Start multi-worker data-parallel training on this machine, one train.py process per worker, with the cluster in the
+TF_CONFIG environment variable of each process. All other arguments are passed on to train.py, ex:
+    python launch_workers.py --workers 2 --gpus 0 1 --strategy multi_worker --dataset_path /data/tma/
+Without --gpus, the workers train on CPU (ex: to test multi-worker training). To train on several nodes, set TF_CONFIG
+on each node and start train.py --strategy multi_worker there instead, see
+https://www.tensorflow.org/guide/distributed_training#setting_up_the_tf_config_environment_variable
+"""
+from argparse import ArgumentParser
+import json
+import os
+import subprocess
+import sys
+import time
+
+
+if __name__ == "__main__":
+    # no abbreviations, --gpu of train.py must not be taken for --gpus
+    parser = ArgumentParser(allow_abbrev=False)
+    parser.add_argument('--workers', type=int, nargs='?', default=2,
+                        help="number of worker processes to start.")
+    parser.add_argument('--port', type=int, nargs='?', default=20000,
+                        help="first port of the workers, worker i listens on port + i.")
+    parser.add_argument('--gpus', type=str, nargs='*', default=None,
+                        help="GPU of each worker (--gpu of train.py). Workers train on CPU if not set.")
+    ret, train_args = parser.parse_known_args(sys.argv[1:])
+
+    if ret.gpus is not None and len(ret.gpus) != ret.workers:
+        raise ValueError("Give one GPU per worker with --gpus.")
+    if not any(x.split("=")[0] == "--strategy" for x in train_args):
+        train_args += ["--strategy", "multi_worker"]
+
+    train_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "train.py")
+    cluster = {"worker": ["localhost:" + str(ret.port + i) for i in range(ret.workers)]}
+    processes = []
+    for i in range(ret.workers):
+        env = dict(os.environ, TF_CONFIG=json.dumps({"cluster": cluster, "task": {"type": "worker", "index": i}}))
+        gpu = ret.gpus[i] if ret.gpus is not None else ""
+        processes.append(subprocess.Popen([sys.executable, train_path] + train_args + ["--gpu", gpu], env=env))
+
+    # the other workers wait forever in the collective ops if one of them fails
+    try:
+        while any(p.poll() is None for p in processes):
+            if any(p.poll() not in (None, 0) for p in processes):
+                print("A worker failed, stopping the other workers.")
+                break
+            time.sleep(1)
+    finally:
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+        for p in processes:
+            p.wait()
+    sys.exit(max(abs(p.returncode) for p in processes))
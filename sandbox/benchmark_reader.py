@@ -0,0 +1,100 @@
+"""
+Benchmark patch reading throughput (samples/sec): tf.py_function + patchReader (current train.py path) against
+TFRecords decoded natively in tf.data.
+Either point to an existing dataset directory (one class folder, ex: ds_train/invasive/) or use --synthetic to
+generate random patches in a temporary directory.
+"""
+import tensorflow as tf
+import numpy as np
+import h5py
+import os
+import sys
+import shutil
+import tempfile
+import time
+from argparse import ArgumentParser
+from source.utils import patchReader, labelmapReader, one_hot_labelmap, list_patch_paths
+from source.records import export_to_tfrecords, record_dataset
+
+
+def create_synthetic_dataset(dir_path, nbr_patches, img_size, nb_classes):
+    for i in range(nbr_patches):
+        gt = np.random.randint(0, nb_classes, (img_size, img_size)).astype("uint8")
+        with h5py.File(dir_path + "patch_" + str(i) + ".h5", "w") as f:
+            f.create_dataset(name="input", data=np.random.randint(0, 255, (img_size, img_size, 3)).astype("uint8"))
+            f.create_dataset(name="output", data=np.eye(nb_classes, dtype="float32")[gt])
+
+
+def samples_per_sec(ds, nbr_samples, warmup):
+    iterator = iter(ds)
+    for _ in range(warmup):
+        next(iterator)
+    start = time.perf_counter()
+    for _ in range(nbr_samples):
+        next(iterator)
+    return nbr_samples / (time.perf_counter() - start)
+
+
+def main(ret):
+    tmp_path = None
+    if ret.synthetic:
+        tmp_path = tempfile.mkdtemp() + "/"
+        dir_path = tmp_path + "patches/"
+        os.makedirs(dir_path)
+        create_synthetic_dataset(dir_path, ret.synthetic, ret.img_size, ret.nbr_classes)
+    else:
+        dir_path = ret.dataset_path.rstrip("/") + "/"
+
+    paths = list_patch_paths(dir_path)
+    if ret.records_path is None:
+        records_path = (tmp_path if tmp_path is not None else tempfile.mkdtemp() + "/") + "records/"
+        print("Exporting", len(paths), "patches to TFRecords...")
+        files = export_to_tfrecords(paths, records_path + "part")
+    else:
+        files = [ret.records_path + x for x in os.listdir(ret.records_path)]
+
+    def path_dataset():
+        return tf.data.Dataset.from_tensor_slices(paths).shuffle(len(paths)).repeat()
+
+    pipelines = {
+        "patchReader (tf.py_function)": path_dataset().map(
+            lambda x: tf.py_function(patchReader, [x], [tf.float32, tf.float32]),
+            num_parallel_calls=ret.proc, deterministic=False),
+        "labelmapReader (tf.py_function)": path_dataset().map(
+            lambda x: tf.py_function(labelmapReader, [x], [tf.float32, tf.uint8]),
+            num_parallel_calls=ret.proc, deterministic=False).map(
+            lambda x, y: one_hot_labelmap(x, y, ret.nbr_classes)),
+        "TFRecords (native)": record_dataset(files, ret.img_size, num_parallel_calls=ret.proc).map(
+            lambda x, y: one_hot_labelmap(x, y, ret.nbr_classes), num_parallel_calls=ret.proc),
+    }
+
+    for name, ds in pipelines.items():
+        ds = ds.prefetch(1)
+        print(name + ": " + "%.1f" % samples_per_sec(ds, ret.nbr_samples, ret.warmup) + " samples/sec")
+
+    if tmp_path is not None:
+        shutil.rmtree(tmp_path)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument('--dataset_path', type=str, nargs='?', default=None,
+                        help="path to folder with .h5 patches, ex: ds_train/invasive/.")
+    parser.add_argument('--records_path', type=str, nargs='?', default=None,
+                        help="path to folder with the same patches as TFRecords. Exported to a temporary folder "
+                             "if not set.")
+    parser.add_argument('--synthetic', type=int, nargs='?', default=0,
+                        help="generate this many random patches instead of using --dataset_path.")
+    parser.add_argument('--img_size', type=int, nargs='?', default=1024,
+                        help="patch size.")
+    parser.add_argument('--nbr_classes', type=int, nargs='?', default=4,
+                        help="number of classes, including background.")
+    parser.add_argument('--proc', type=int, nargs='?', default=4,
+                        help="number of parallel calls in tf.data.")
+    parser.add_argument('--nbr_samples', type=int, nargs='?', default=200,
+                        help="number of samples to time.")
+    parser.add_argument('--warmup', type=int, nargs='?', default=20,
+                        help="number of samples to read before timing.")
+    ret = parser.parse_known_args(sys.argv[1:])[0]
+
+    main(ret)
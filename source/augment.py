@@ -1,64 +1,169 @@
 import tensorflow as tf
 import tensorflow_addons as tfa
-import random
+
+
+# Random numbers. All augmentations take an optional seed (int tensor of shape (2,)). Without it the stateful RNG is
+# used as before. With it, augmentations are stateless: the same seed (ex: from element_seed) always gives the same
+# augmentation, independent of parallelism and the order elements are processed in
+def fold_seed(seed, salt):
+    """
+    Derive an independent seed, for each random draw from the same seed
+    """
+    return None if seed is None else tf.random.experimental.stateless_fold_in(seed, salt)
+
+
+def element_seed(base_seed, index, samples_per_epoch):
+    """
+    Seed of an element from (epoch, index of element in epoch)
+    :param base_seed: run seed (int)
+    :param index: index of element in the (infinite) dataset, from ds.enumerate()
+    :param samples_per_epoch: number of elements drawn each epoch
+    :return: int64 seed of shape (2,)
+    """
+    index = tf.cast(index, tf.int64)
+    seed = tf.stack([tf.constant(base_seed, tf.int64), index // samples_per_epoch])
+    return tf.random.experimental.stateless_fold_in(seed, index % samples_per_epoch)
+
+
+def _uniform(shape, minval=0., maxval=1., dtype=tf.float32, seed=None):
+    if seed is None:
+        return tf.random.uniform(shape=shape, minval=minval, maxval=maxval, dtype=dtype)
+    return tf.random.stateless_uniform(shape=shape, seed=seed, minval=minval, maxval=maxval, dtype=dtype)
+
+
+def _photometric(x, fn):
+    # photometric augmentations work on float images in [0, 1], uint8 images are converted there and back
+    if x.dtype == tf.uint8:
+        return tf.image.convert_image_dtype(fn(tf.image.convert_image_dtype(x, tf.float32)), tf.uint8, saturate=True)
+    return fn(x)
+
+
+def _white(x):
+    # fill value of shifted images
+    return 255. if x.dtype == tf.uint8 else 1.
 
 
 # Augmentations
 def random_brightness(x,
-                      brightness=25):  # look at second input parameter to random_brightness. How to deal with normalized (?)
-    nbr = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
-    x = tf.cond(nbr < 0.5, lambda: x, lambda: tf.clip_by_value(tf.image.random_brightness(x, brightness), 0, 1))
+                      brightness=25, seed=None):  # look at second input parameter to random_brightness. How to deal with normalized (?)
+    nbr = _uniform(shape=[], seed=fold_seed(seed, 0))
+    delta = _uniform(shape=[], minval=-brightness, maxval=brightness, seed=fold_seed(seed, 1))
+    x = tf.cond(nbr < 0.5, lambda: x, lambda: _photometric(
+        x, lambda z: tf.clip_by_value(tf.image.adjust_brightness(z, delta), 0, 1)))
     return x
 
 
-def random_fliplr(x, y):
-    nbr = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
+def random_fliplr(x, y, seed=None):
+    nbr = _uniform(shape=[], seed=fold_seed(seed, 0))
     x, y = tf.cond(nbr < 0.5, lambda: (x, y), lambda: (tf.image.flip_left_right(x), tf.image.flip_left_right(y)))
     return x, y
 
 
-def random_flipud(x, y):
-    nbr = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
+def random_flipud(x, y, seed=None):
+    nbr = _uniform(shape=[], seed=fold_seed(seed, 0))
     x, y = tf.cond(nbr < 0.5, lambda: (x, y), lambda: (tf.image.flip_up_down(x), tf.image.flip_up_down(y)))
     return x, y
 
 
-def random_rot90(x, y):  # not 90 degrees when k = 1, why??????
-    nbr = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
-    nbr_rot = tf.random.uniform(shape=[], minval=1, maxval=4, dtype=tf.int32)
+def random_rot90(x, y, seed=None):  # not 90 degrees when k = 1, why??????
+    nbr = _uniform(shape=[], seed=fold_seed(seed, 0))
+    nbr_rot = _uniform(shape=[], minval=1, maxval=4, dtype=tf.int32, seed=fold_seed(seed, 1))
     x, y = tf.cond(nbr < 0.5, lambda: (x, y), lambda: (tf.image.rot90(x, k=nbr_rot), tf.image.rot90(y, k=nbr_rot)))
     return x, y
 
 
-def random_hue(x, max_delta):
-    nbr = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
-    x = tf.cond(nbr < 0.5, lambda: x, lambda: tf.clip_by_value(tf.image.random_hue(x, max_delta=max_delta), 0, 1))
+def random_hue(x, max_delta, seed=None):
+    nbr = _uniform(shape=[], seed=fold_seed(seed, 0))
+    delta = _uniform(shape=[], minval=-max_delta, maxval=max_delta, seed=fold_seed(seed, 1))
+    x = tf.cond(nbr < 0.5, lambda: x, lambda: _photometric(
+        x, lambda z: tf.clip_by_value(tf.image.adjust_hue(z, delta), 0, 1)))
     return x
 
 
-def random_saturation(x, saturation):
-    nbr = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
-    x = tf.cond(nbr < 0.5, lambda: x, lambda: tf.clip_by_value(
-        tf.image.random_saturation(x, lower=1 - saturation, upper=1 + saturation), 0, 1))
+def random_saturation(x, saturation, seed=None):
+    nbr = _uniform(shape=[], seed=fold_seed(seed, 0))
+    factor = _uniform(shape=[], minval=1 - saturation, maxval=1 + saturation, seed=fold_seed(seed, 1))
+    x = tf.cond(nbr < 0.5, lambda: x, lambda: _photometric(
+        x, lambda z: tf.clip_by_value(tf.image.adjust_saturation(z, factor), 0, 1)))
     return x
 
 
-@tf.function
-def random_blur(x):
-    nbr = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
-    sigma_ = random.uniform(1, 3)  # @TODO: find a way to avoid numpy, will switch to cpu
-    x = tf.cond(nbr < 0.9, lambda: x, lambda: tf.clip_by_value(tfa.image.gaussian_filter2d(
-        x, filter_shape=15, sigma=sigma_), 0, 1))   # @TODO: get tf warning sometimes, find out why
+def gaussian_kernel1d(sigma, filter_shape=15):
+    """
+    :param sigma: standard deviation, scalar or tensor of shape (n,)
+    :param filter_shape: kernel size (odd)
+    :return: normalized 1-D Gaussian kernel of shape (filter_shape,), or (n, filter_shape)
+    """
+    sigma = tf.cast(sigma, tf.float32)
+    x = tf.range(-(filter_shape // 2), filter_shape // 2 + 1, dtype=tf.float32)
+    kernel = tf.exp(-tf.square(x) / (2. * tf.square(tf.expand_dims(sigma, -1))))
+    return kernel / tf.reduce_sum(kernel, axis=-1, keepdims=True)
+
+
+def gaussian_kernel_bank(sigma_min=1., sigma_max=3., nbr_kernels=16, filter_shape=15):
+    """
+    Precomputed 1-D kernels for sigmas evenly spaced in [sigma_min, sigma_max], to draw from in random_blur
+    :return: tensor of shape (nbr_kernels, filter_shape)
+    """
+    return gaussian_kernel1d(tf.linspace(sigma_min, sigma_max, nbr_kernels), filter_shape)
+
+
+def separable_blur(x, kernels):
+    """
+    Gaussian blur as two 1-D convolutions (columns, then rows), with reflect padding as tfa.image.gaussian_filter2d
+    :param x: image (height, width, channels) or batch of images
+    :param kernels: 1-D kernel of shape (filter_shape,), or one kernel per sample of shape (batch, filter_shape)
+    :return: blurred x
+    """
+    if x.shape.rank is None:
+        raise ValueError("separable_blur needs the rank of x, set its shape first (ex: tf.ensure_shape).")
+    single = x.shape.rank == 3
+    if single:
+        x = x[tf.newaxis]
+    shape = tf.shape(x)
+    # number of channels only known when running if not in the static shape
+    channels = x.shape[-1] if x.shape[-1] is not None else shape[3]
+    filter_shape = kernels.shape[-1]
+    kernels = tf.broadcast_to(tf.reshape(tf.cast(kernels, x.dtype), [-1, filter_shape]), [shape[0], filter_shape])
+    # samples are moved to the channel axis, so each sample is convolved with its own kernel by one depthwise conv
+    x = tf.reshape(tf.transpose(x, [1, 2, 0, 3]), [1, shape[1], shape[2], -1])
+    kernels = tf.reshape(tf.repeat(kernels, channels, axis=0), [-1, filter_shape])  # (batch * channels, filter_shape)
+    kernels = tf.transpose(kernels)[:, tf.newaxis, :, tf.newaxis]  # (filter_shape, 1, batch * channels, 1)
+    pad = filter_shape // 2
+    x = tf.pad(x, [[0, 0], [pad, pad], [pad, pad], [0, 0]], mode="REFLECT")
+    x = tf.nn.depthwise_conv2d(x, kernels, strides=[1, 1, 1, 1], padding="VALID")
+    x = tf.nn.depthwise_conv2d(x, tf.transpose(kernels, [1, 0, 2, 3]), strides=[1, 1, 1, 1], padding="VALID")
+    x = tf.transpose(tf.reshape(x, [shape[1], shape[2], shape[0], channels]), [2, 0, 1, 3])
+    return x[0] if single else x
+
+
+def _random_blur_kernels(nbr_samples, sigma_range=(1, 3), filter_shape=15, kernel_bank=None, seed=None):
+    if kernel_bank is not None:
+        return tf.gather(kernel_bank, _uniform([nbr_samples], 0, tf.shape(kernel_bank)[0], tf.int32, seed=seed))
+    sigma = _uniform([nbr_samples], minval=sigma_range[0], maxval=sigma_range[1], seed=seed)
+    return gaussian_kernel1d(sigma, filter_shape)
+
+
+def random_blur(x, sigma_range=(1, 3), filter_shape=15, kernel_bank=None, seed=None):
+    """
+    Blur 10 % of images with a Gaussian with sigma drawn in the graph, either uniformly in sigma_range or from a kernel
+    bank (see gaussian_kernel_bank)
+    """
+    nbr = _uniform(shape=[], seed=fold_seed(seed, 0))
+    kernel = _random_blur_kernels(1, sigma_range, filter_shape, kernel_bank, seed=fold_seed(seed, 1))[0]
+    x = tf.cond(nbr < 0.9, lambda: x, lambda: _photometric(
+        x, lambda z: tf.clip_by_value(separable_blur(z, kernel), 0, 1)))
     return x
 
 
 #  @TODO: consider adding additive gaussian noise too
 
 
-def random_contrast(x, low, up):
-    nbr = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
-    x = tf.cond(nbr < 0.5, lambda: x, lambda: tf.clip_by_value(
-        tf.image.random_contrast(x, lower=low, upper=up), 0, 1))
+def random_contrast(x, low, up, seed=None):
+    nbr = _uniform(shape=[], seed=fold_seed(seed, 0))
+    factor = _uniform(shape=[], minval=low, maxval=up, seed=fold_seed(seed, 1))
+    x = tf.cond(nbr < 0.5, lambda: x, lambda: _photometric(
+        x, lambda z: tf.clip_by_value(tf.image.adjust_contrast(z, factor), 0, 1)))
     return x
 
 
@@ -71,14 +176,191 @@ def gt_shift(z, shift_x, shift_y):
     return z
 
 
-def random_shift(x, y, translate=50):
-    choice = tf.random.uniform(shape=[], minval=0., maxval=1., dtype=tf.float32)
-    shift_x = tf.random.uniform(shape=[], minval=-translate, maxval=translate, dtype=tf.int32)
-    shift_y = tf.random.uniform(shape=[], minval=-translate, maxval=translate, dtype=tf.int32)
+def random_shift(x, y, translate=50, seed=None):
+    choice = _uniform(shape=[], seed=fold_seed(seed, 0))
+    shift_x = _uniform(shape=[], minval=-translate, maxval=translate, dtype=tf.int32, seed=fold_seed(seed, 1))
+    shift_y = _uniform(shape=[], minval=-translate, maxval=translate, dtype=tf.int32, seed=fold_seed(seed, 2))
 
     x, y = tf.cond(choice < 0.5, lambda: (x, y), lambda: (
-        tfa.image.translate(x, (shift_x, shift_y), fill_value=1.),
+        tfa.image.translate(x, (shift_x, shift_y), fill_value=_white(x)),
         gt_shift(y, shift_x, shift_y),
     )
                    )
     return x, y
+
+
+def random_crop(x, y, size, seed=None):
+    """
+    Crop image and gt at the same random position
+    :param size: height and width of the crop
+    """
+    top = _uniform(shape=[], minval=0, maxval=tf.shape(x)[0] - size + 1, dtype=tf.int32, seed=fold_seed(seed, 0))
+    left = _uniform(shape=[], minval=0, maxval=tf.shape(x)[1] - size + 1, dtype=tf.int32, seed=fold_seed(seed, 1))
+    return tf.slice(x, [top, left, 0], [size, size, -1]), tf.slice(y, [top, left, 0], [size, size, -1])
+
+
+def center_crop(x, y, size):
+    top = (tf.shape(x)[0] - size) // 2
+    left = (tf.shape(x)[1] - size) // 2
+    return tf.slice(x, [top, left, 0], [size, size, -1]), tf.slice(y, [top, left, 0], [size, size, -1])
+
+
+# Batched augmentations, applied to a whole batch (after ds.batch) as one stage. Random parameters are drawn per
+# sample, and each augmentation is applied to a sample with the same probability as the per-sample versions above.
+# Selecting with tf.where over the whole batch was measured slower on CPU than the fused per-image kernels with
+# tf.cond (which skips samples that are not augmented), so ops are applied per sample inside the stage. With a static
+# batch size (ds.batch(..., drop_remainder=True)) samples are unrolled and run in parallel on the inter-op threads
+def _sample_mask(x, prob=0.5, seed=None):
+    # True for samples that should be augmented
+    return _uniform(shape=[tf.shape(x)[0]], seed=seed) >= prob
+
+
+def _map_samples(fn, elems, dtypes):
+    # apply fn to each sample of the tensors in elems, fn returns a tuple
+    batch_size = elems[0].shape[0]
+    if batch_size is None:
+        return tf.map_fn(lambda z: fn(*z), elems, fn_output_signature=dtypes)
+    outputs = [fn(*[elem[i] for elem in elems]) for i in range(batch_size)]
+    return tuple(tf.stack(list(output), axis=0) for output in zip(*outputs))
+
+
+def _hue(x, delta, choice):
+    return tf.cond(choice, lambda: _photometric(x, lambda z: tf.clip_by_value(tf.image.adjust_hue(z, delta), 0, 1)),
+                   lambda: x)
+
+
+def _saturation(x, factor, choice):
+    return tf.cond(choice, lambda: _photometric(
+        x, lambda z: tf.clip_by_value(tf.image.adjust_saturation(z, factor), 0, 1)), lambda: x)
+
+
+def _dihedral(x, y, transpose, ud, lr):
+    # transpose, then flip up-down and left-right
+    x, y = tf.cond(transpose, lambda: (tf.transpose(x, [1, 0, 2]), tf.transpose(y, [1, 0, 2])), lambda: (x, y))
+    axis = tf.boolean_mask([0, 1], tf.stack([ud, lr]))
+    return tf.cond(tf.size(axis) > 0, lambda: (tf.reverse(x, axis), tf.reverse(y, axis)), lambda: (x, y))
+
+
+def _blur(x, kernel, choice):
+    return tf.cond(choice, lambda: _photometric(x, lambda z: tf.clip_by_value(separable_blur(z, kernel), 0, 1)),
+                   lambda: x)
+
+
+def _shift(x, y, shift, choice):
+    return tf.cond(choice, lambda: (tfa.image.translate(x, shift, fill_value=_white(x)),
+                                    gt_shift(y, shift[0], shift[1])), lambda: (x, y))
+
+
+def batch_random_brightness(x, brightness=25, seed=None):
+    delta = _uniform(shape=[tf.shape(x)[0]], minval=-brightness, maxval=brightness, seed=fold_seed(seed, 1))
+    delta = tf.where(_sample_mask(x, seed=fold_seed(seed, 0)), delta, tf.zeros_like(delta))
+    return _photometric(x, lambda z: tf.clip_by_value(z + tf.reshape(delta, [-1, 1, 1, 1]), 0, 1))
+
+
+def batch_random_hue(x, max_delta, seed=None):
+    delta = _uniform(shape=[tf.shape(x)[0]], minval=-max_delta, maxval=max_delta, seed=fold_seed(seed, 1))
+    return _map_samples(lambda *z: (_hue(*z),), (x, delta, _sample_mask(x, seed=fold_seed(seed, 0))), (x.dtype,))[0]
+
+
+def batch_random_saturation(x, saturation, seed=None):
+    factor = _uniform(shape=[tf.shape(x)[0]], minval=1 - saturation, maxval=1 + saturation, seed=fold_seed(seed, 1))
+    return _map_samples(lambda *z: (_saturation(*z),), (x, factor, _sample_mask(x, seed=fold_seed(seed, 0))),
+                        (x.dtype,))[0]
+
+
+def batch_random_blur(x, sigma_range=(1, 3), filter_shape=15, kernel_bank=None, seed=None):
+    # only the samples to blur are gathered and blurred together, each with its own sigma
+    indices = tf.where(_sample_mask(x, prob=0.9, seed=fold_seed(seed, 0)))
+    kernels = _random_blur_kernels(tf.shape(indices)[0], sigma_range, filter_shape, kernel_bank,
+                                   seed=fold_seed(seed, 1))
+
+    def blur():
+        blurred = _photometric(tf.gather_nd(x, indices),
+                               lambda z: tf.clip_by_value(separable_blur(z, kernels), 0, 1))
+        return tf.tensor_scatter_nd_update(x, indices, blurred)
+
+    return tf.cond(tf.size(indices) > 0, blur, lambda: x)
+
+
+def _random_rot90_flags(x, seed=None):
+    # rotation by k * 90 degrees (as tf.image.rot90) is transpose if k is odd, then flip up-down if k is 1 or 2 and
+    # flip left-right if k is 2 or 3 (requires square patches)
+    k = _uniform(shape=[tf.shape(x)[0]], minval=1, maxval=4, dtype=tf.int32, seed=fold_seed(seed, 1))
+    k = tf.where(_sample_mask(x, seed=fold_seed(seed, 0)), k, tf.zeros_like(k))
+    return tf.math.floormod(k, 2) == 1, (k == 1) | (k == 2), (k == 2) | (k == 3)
+
+
+def _random_dihedral_flags(x, rot=True, flip=True, seed=None):
+    # random rot90 followed by random flip up-down and left-right, as one transpose and flips of each sample
+    no_flip = tf.zeros([tf.shape(x)[0]], dtype=tf.bool)
+    transpose, ud, lr = _random_rot90_flags(x, seed=fold_seed(seed, 0)) if rot else (no_flip, no_flip, no_flip)
+    if flip:
+        # flips commute, so flipping a rotated sample only toggles its flips
+        ud = tf.math.logical_xor(ud, _sample_mask(x, seed=fold_seed(seed, 1)))
+        lr = tf.math.logical_xor(lr, _sample_mask(x, seed=fold_seed(seed, 2)))
+    return transpose, ud, lr
+
+
+def batch_random_rot90(x, y, seed=None):
+    return _map_samples(_dihedral, (x, y, *_random_dihedral_flags(x, flip=False, seed=seed)), (x.dtype, y.dtype))
+
+
+def batch_random_flip(x, y, seed=None):
+    return _map_samples(_dihedral, (x, y, *_random_dihedral_flags(x, rot=False, seed=seed)), (x.dtype, y.dtype))
+
+
+def batch_random_shift(x, y, translate=50, seed=None):
+    shifts = _uniform(shape=[tf.shape(x)[0], 2], minval=-translate, maxval=translate, dtype=tf.int32,
+                      seed=fold_seed(seed, 1))
+    shifts = tf.cast(shifts, tf.float32)
+    return _map_samples(_shift, (x, y, shifts, _sample_mask(x, seed=fold_seed(seed, 0))), (x.dtype, y.dtype))
+
+
+def batch_augment(x, y, brightness=0, hue=0, saturation=0, blur=0, rot=0, flip=0, shift=0, translate=50,
+                  sigma_range=(1, 3), filter_shape=15, kernel_bank=None, seed=None):
+    """
+    All enabled augmentations in the same order as the per-sample augmentations in train.py, as one stage. Random
+    parameters of all augmentations are drawn for the whole batch first, then each sample goes through all its
+    augmentations (rot90 and flips fused into one transform)
+    :param x: batch of images in [0, 1], or uint8 images
+    :param y: batch of one-hot gts (full resolution)
+    :param translate: maximum shift in pixels, as in random_shift
+    :param sigma_range: range of blur sigma, as in random_blur
+    :param filter_shape: size of blur kernel, as in random_blur
+    :param kernel_bank: blur kernels to draw from instead of sigma_range (see gaussian_kernel_bank), as in random_blur
+    :param seed: seed of batch (ex: element_seed of first sample), stateful RNG if None
+    :return: augmented x and y
+    """
+    if brightness:
+        x = batch_random_brightness(x, brightness=brightness, seed=fold_seed(seed, 0))
+
+    batch_size = tf.shape(x)[0]
+    hue_delta = _uniform(shape=[batch_size], minval=-hue, maxval=hue, seed=fold_seed(seed, 1))
+    saturation_factor = _uniform(shape=[batch_size], minval=1 - saturation, maxval=1 + saturation,
+                                 seed=fold_seed(seed, 2))
+    transpose, ud, lr = _random_dihedral_flags(x, rot=bool(rot), flip=bool(flip), seed=fold_seed(seed, 3))
+    shifts = tf.cast(_uniform(shape=[batch_size, 2], minval=-translate, maxval=translate, dtype=tf.int32,
+                              seed=fold_seed(seed, 4)), tf.float32)
+    blur_kernels = _random_blur_kernels(batch_size, sigma_range, filter_shape, kernel_bank, seed=fold_seed(seed, 5))
+    params = (hue_delta, _sample_mask(x, seed=fold_seed(seed, 6)), saturation_factor,
+              _sample_mask(x, seed=fold_seed(seed, 7)), blur_kernels,
+              _sample_mask(x, prob=0.9, seed=fold_seed(seed, 8)), transpose, ud, lr, shifts,
+              _sample_mask(x, seed=fold_seed(seed, 9)))
+
+    def augment_sample(x_, y_, hue_delta_, hue_choice, saturation_factor_, saturation_choice, blur_kernel,
+                       blur_choice, transpose_, ud_, lr_, shift_, shift_choice):
+        if hue:
+            x_ = _hue(x_, hue_delta_, hue_choice)
+        if saturation:
+            x_ = _saturation(x_, saturation_factor_, saturation_choice)
+        if blur:
+            x_ = _blur(x_, blur_kernel, blur_choice)
+        if rot or flip:
+            x_, y_ = _dihedral(x_, y_, transpose_, ud_, lr_)
+        if shift:
+            x_, y_ = _shift(x_, y_, shift_, shift_choice)
+        return x_, y_
+
+    if not (hue or saturation or blur or rot or flip or shift):
+        return x, y
+    return _map_samples(augment_sample, (x, y) + params, (x.dtype, y.dtype))
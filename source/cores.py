@@ -0,0 +1,51 @@
+"""
+Stored TMA cores. Instead of overlapping patches, each registered H&E core is stored once with its uint8 label map in
+a "<name>.core.h5" file (same "input"/"output" datasets as a patch file, see create_data_tma.py). Patches are random
+crops of the core, drawn every time the core is read during training.
+"""
+import numpy as np
+
+
+CORE_SUFFIX = ".core.h5"
+
+
+def is_core(path):
+    return path.endswith(CORE_SUFFIX)
+
+
+def random_core_crop(image, gt, crop_size, min_tissue=0., max_tries=10, seed=None):
+    """
+    Random crop of a core, redrawn until it is covered by enough tissue. Cores smaller than the crop are padded with
+    white and background
+    :param image: uint8 core image
+    :param gt: core gt, label map or one-hot
+    :param crop_size: height and width of crop
+    :param min_tissue: minimum fraction of crop covered by tissue, same threshold as when creating the datasets
+    :param max_tries: number of crops drawn, the crop with most tissue is kept if none has enough
+    :param seed: seed of the crop positions (non-negative int), ex: drawn from the element seed in the tf.data graph,
+        for the same crops whichever thread reads the core. Not seeded if None
+    :return: image and gt crops
+    """
+    pad_h = max(crop_size - image.shape[0], 0)
+    pad_w = max(crop_size - image.shape[1], 0)
+    if pad_h or pad_w:
+        image = np.pad(image, [[0, pad_h], [0, pad_w], [0, 0]], constant_values=255)
+        gt = np.pad(gt, [[0, pad_h], [0, pad_w]] + [[0, 0]] * (gt.ndim - 2))
+        if gt.ndim == 3:  # padding is background
+            gt[image.shape[0] - pad_h:, :, 0] = 1
+            gt[:, image.shape[1] - pad_w:, 0] = 1
+
+    intensity_away_from_white_thresh = 40
+    rng = np.random.default_rng(seed)
+    best, best_tissue = None, -1
+    for _ in range(max_tries):
+        y = rng.integers(0, image.shape[0] - crop_size + 1)
+        x = rng.integers(0, image.shape[1] - crop_size + 1)
+        crop = image[y:y + crop_size, x:x + crop_size]
+        tissue = np.mean(np.mean(crop, axis=-1) < 255 - intensity_away_from_white_thresh)
+        if tissue > best_tissue:
+            best, best_tissue = (y, x), tissue
+        if tissue >= min_tissue:
+            break
+    y, x = best
+    return image[y:y + crop_size, x:x + crop_size], gt[y:y + crop_size, x:x + crop_size]
@@ -0,0 +1,72 @@
+"""
+Data-parallel training with tf.distribute. The model is replicated on all devices of this process ("mirrored") or of
+all worker processes ("multi_worker", cluster given by the TF_CONFIG environment variable, see launch_workers.py).
+Each replica trains on its own share of the global batch, and gradients are summed across replicas every step.
+Each worker process runs its own input pipeline (see create_datasets in train.py), batched per replica.
+"""
+from contextlib import nullcontext
+import tensorflow as tf
+
+
+STRATEGIES = ["none", "mirrored", "multi_worker"]
+
+
+def split_cpu(nb_replicas):
+    """
+    Split the CPU into logical devices, to run mirrored training with several replicas on a machine without GPUs (ex:
+    for testing). Must be called before TensorFlow initializes its devices
+    :param nb_replicas: number of logical CPU devices
+    """
+    cpus = tf.config.list_physical_devices("CPU")
+    tf.config.set_logical_device_configuration(cpus[0], [tf.config.LogicalDeviceConfiguration()] * nb_replicas)
+
+
+def create_strategy(name, cpu_replicas=0):
+    """
+    :param name: one of STRATEGIES
+    :param cpu_replicas: number of logical CPU devices made by split_cpu, mirrored training then uses them instead of
+        the GPUs. 0 if not split
+    :return: distribution strategy, None for "none"
+    """
+    if name == "none":
+        return None
+    if name == "mirrored":
+        # all visible GPUs (see --gpu), or one CPU device if there is none
+        devices = [x.name for x in tf.config.list_logical_devices("CPU")] if cpu_replicas else None
+        return tf.distribute.MirroredStrategy(devices)
+    if name == "multi_worker":
+        if cpu_replicas:
+            raise ValueError("Multi-worker training uses a single CPU device in each worker, start several local "
+                             "workers with launch_workers.py instead of splitting the CPU.")
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise ValueError("Unsupported strategy chosen. Please, choose one of: " + ", ".join(STRATEGIES) + ".")
+
+
+def strategy_scope(strategy):
+    """
+    :return: scope of the strategy, to create the model, optimizer and metrics in. No-op if strategy is None
+    """
+    return strategy.scope() if strategy is not None else nullcontext()
+
+
+def input_context(strategy):
+    """
+    :return: tf.distribute.InputContext of the input pipeline of this process. Workers are numbered as by
+        MultiWorkerMirroredStrategy (chief first), worker 0 is the chief
+    """
+    resolver = strategy.cluster_resolver
+    cluster = resolver.cluster_spec().as_dict() if resolver is not None else {}
+    if not cluster:
+        return tf.distribute.InputContext(1, 0, strategy.num_replicas_in_sync)
+    nb_chiefs = len(cluster.get("chief", []))
+    pipeline_id = 0 if resolver.task_type == "chief" else nb_chiefs + resolver.task_id
+    return tf.distribute.InputContext(nb_chiefs + len(cluster.get("worker", [])), pipeline_id,
+                                      strategy.num_replicas_in_sync)
+
+
+def distribute_dataset(strategy, dataset):
+    """
+    :param dataset: dataset of the input pipeline of this process, batched per replica
+    :return: distributed dataset, each replica of this process gets the next batch in turn
+    """
+    return strategy.distribute_datasets_from_function(lambda context: dataset)
@@ -0,0 +1,153 @@
+"""
+Multi-process patch loader. Worker processes (source.loader_worker, without TensorFlow) read patches (read_labelmap,
+including core crops and the shared patch cache) and write them into a ring buffer of slots in shared memory, which the
+tf.data pipeline reads from. Reading, decoding and cropping then run outside of the trainer process, without holding
+its GIL as tf.py_function does. Each patch is still copied out of its slot in the trainer, one at a time by the
+tf.data.Dataset.from_generator thread while holding the GIL (a memcpy, not zero-copy)
+"""
+import atexit
+import contextlib
+import multiprocessing as mp
+import os
+import queue
+import sys
+import threading
+from multiprocessing import shared_memory
+import numpy as np
+import tensorflow as tf
+from source import loader_worker
+
+
+@contextlib.contextmanager
+def _without_main_path():
+    """
+    Hides the path of the __main__ script (ex: train.py) from multiprocessing while starting spawned processes, which
+    would otherwise run it as __mp_main__ in each worker and import TensorFlow with it. The workers only need
+    source.loader_worker
+    """
+    main = sys.modules["__main__"]
+    path = getattr(main, "__file__", None)
+    if path is not None:
+        del main.__file__
+    try:
+        yield
+    finally:
+        if path is not None:
+            main.__file__ = path
+
+
+class SharedMemoryLoader:
+    """
+    Reads patches in nb_workers processes into nb_slots shared memory slots. Slots are handed out to workers as paths
+    come in, and back to the tf.data pipeline in the order the workers finish them (not the order of the paths).
+    Only one generator is used at a time, a new generator (ex: pipeline of the next schedule phase) takes the slots
+    over and the previous one stops
+    """
+    def __init__(self, nb_workers, img_size=1024, nb_slots=None, min_tissue=0., shm_cache=None):
+        """
+        :param nb_workers: number of worker processes
+        :param img_size: height and width of patches (crop size of stored cores)
+        :param nb_slots: number of patches in the ring buffer, 2 per worker if None
+        :param min_tissue: minimum tissue fraction of crops of stored cores
+        :param shm_cache: directory of shared patch cache used by the workers (see SharedPatchCache), None to disable
+        """
+        self.img_size = img_size
+        self.nb_slots = nb_slots or 2 * nb_workers
+        slot_bytes = img_size * img_size * 4  # uint8 image and label map
+        self.shm = shared_memory.SharedMemory(create=True, size=self.nb_slots * slot_bytes)
+        self.images, self.gts = loader_worker.slot_views(self.shm.buf, self.nb_slots, img_size)
+        self.pending = 0  # patches given to workers and not yet handed out
+        self.generation = 0  # number of generators started, only the last one is served
+        self.lock = threading.Lock()  # an old generator may still be called from a tf.data thread
+
+        # spawn, forking the trainer process after TensorFlow has started is unsafe
+        context = mp.get_context("spawn")
+        self.tasks = context.Queue()
+        self.ready = context.Queue()
+        args = (self.shm.name, self.nb_slots, img_size, min_tissue, shm_cache, self.tasks, self.ready)
+        self.workers = [context.Process(target=loader_worker.worker, args=args, daemon=True)
+                        for _ in range(nb_workers)]
+        with _without_main_path():
+            for worker in self.workers:
+                worker.start()
+        atexit.register(self.close)
+
+    def generate(self, paths):
+        """
+        :param paths: iterator of patch paths
+        :return: generator of (image, label map), each copied out of its slot (holding the GIL) as it is yielded
+        """
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            # patches still being read for a previous generator
+            while self.pending > 0:
+                self._next_ready()
+                self.pending -= 1
+            for slot in range(self.nb_slots):
+                self.tasks.put((slot, next(paths)))
+                self.pending += 1
+        while True:
+            with self.lock:
+                if self.generation != generation:
+                    return
+                slot, error = self._next_ready()
+                self.pending -= 1
+                if error is not None:
+                    raise RuntimeError("Failed to read patch " + error)
+                # copy, tf.data wraps aligned arrays without copying and may still hold an item in its buffers
+                # (parallel maps, batch, prefetch) when the slot is rewritten by a worker
+                image, gt = np.array(self.images[slot]), np.array(self.gts[slot])
+                self.tasks.put((slot, next(paths)))
+                self.pending += 1
+            yield image, gt
+
+    def _next_ready(self):
+        while True:
+            try:
+                return self.ready.get(timeout=10)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError("A loader worker process died, see its output above.")
+
+    def dataset(self, ds_paths):
+        """
+        :param ds_paths: dataset of patch paths, ex: from class_balanced_path_dataset
+        :return: dataset of uint8 images and uint8 label maps
+        """
+        def generator():
+            return self.generate(x.decode("utf-8") for x in ds_paths.as_numpy_iterator())
+
+        return tf.data.Dataset.from_generator(generator, output_signature=(
+            tf.TensorSpec((self.img_size, self.img_size, 3), tf.uint8),
+            tf.TensorSpec((self.img_size, self.img_size), tf.uint8)))
+
+    def cpu_time(self):
+        """
+        :return: user and system CPU time of the live worker processes in seconds (os.times only counts children
+            after they exit), 0 where /proc is not available
+        """
+        seconds = 0.
+        for worker in self.workers:
+            try:
+                with open("/proc/" + str(worker.pid) + "/stat") as f:
+                    # fields after the process name, which may contain spaces: utime and stime are fields 14 and 15
+                    fields = f.read().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            seconds += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        return seconds
+
+    def close(self):
+        if self.shm is None:
+            return
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        del self.images, self.gts
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
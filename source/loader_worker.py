@@ -0,0 +1,41 @@
+"""
+Worker process of source.loader.SharedMemoryLoader. Imports only numpy and source.patches, not TensorFlow, so that
+starting a worker does not start TensorFlow
+"""
+import traceback
+from multiprocessing import shared_memory
+import numpy as np
+from source.patches import read_labelmap, enable_shared_patch_cache
+
+
+def slot_views(buffer, nb_slots, img_size):
+    """
+    :return: uint8 arrays of images (nb_slots, img_size, img_size, 3) and label maps (nb_slots, img_size, img_size)
+        backed by buffer
+    """
+    images = np.ndarray((nb_slots, img_size, img_size, 3), dtype="uint8", buffer=buffer)
+    gts = np.ndarray((nb_slots, img_size, img_size), dtype="uint8", buffer=buffer, offset=images.nbytes)
+    return images, gts
+
+
+def worker(shm_name, nb_slots, img_size, min_tissue, shm_cache, tasks, ready):
+    """
+    Reads the (slot, path) tasks into the slots until a None task, and puts (slot, None) in ready for each patch read,
+    or (slot, error message) if reading failed
+    """
+    if shm_cache:
+        enable_shared_patch_cache(shm_cache)
+    shm = shared_memory.SharedMemory(name=shm_name)
+    images, gts = slot_views(shm.buf, nb_slots, img_size)
+    try:
+        for slot, path in iter(tasks.get, None):
+            try:
+                images[slot], gts[slot] = read_labelmap(path, as_uint8=True, crop_size=img_size,
+                                                        min_tissue=min_tissue)
+            except Exception:
+                ready.put((slot, path + "\n" + traceback.format_exc()))
+                continue
+            ready.put((slot, None))
+    finally:
+        del images, gts
+        shm.close()
@@ -1,9 +1,31 @@
 import tensorflow as tf
 
 
+def match_resolution(target, output):
+    """
+    Downsample the full resolution target to the resolution of a deep supervision output, by taking every 2^i-th
+    pixel as create_multiscale_input did in the input pipeline. Unchanged for the full resolution output
+    :param target: full resolution target, (batch, height, width[, depth], classes)
+    :param output: model output, at full resolution or downsampled by a power of 2
+    :return: target at the resolution of output
+    """
+    if target.shape[1] is not None and output.shape[1] is not None:
+        # static stride, as needed to compile the loss with XLA
+        factor = target.shape[1] // output.shape[1]
+        if factor == 1:
+            return target
+    else:
+        factor = tf.shape(target)[1] // tf.shape(output)[1]
+    return target[(slice(None),) + (slice(None, None, factor),) * (len(target.shape) - 2)]
+
+
 # By Erik Smistad (from network.get_dice_loss()
 def get_dice_loss(nb_classes=2, dims=2, use_background=False):
     def dice_loss(target, output, epsilon=1e-10):
+        # the same full resolution target is given for all deep supervision outputs
+        target = match_resolution(target, output)
+        # sums over all pixels of the batch, not precise enough in bfloat16/float16
+        target, output = tf.cast(target, tf.float32), tf.cast(output, tf.float32)
         # @TODO: could I change the smoothing?
         smooth = 1.
         dice = 0
@@ -27,6 +49,8 @@ def get_dice_loss(nb_classes=2, dims=2, use_background=False):
 
 def class_dice_loss(class_val, metric_name):
     def dice_loss(y_true, y_pred):
+        y_true = match_resolution(y_true, y_pred)
+        y_true, y_pred = tf.cast(y_true, tf.float32), tf.cast(y_pred, tf.float32)
         smooth = 1.
         output1 = y_pred[:, :, :, class_val]
         gt1 = y_true[:, :, :, class_val]
@@ -42,3 +66,19 @@ def class_dice_loss(class_val, metric_name):
     dice_loss.__name__ = metric_name
 
     return dice_loss
+
+
+def per_sample_dice_loss(target, output, nb_classes=2, use_background=False):
+    """
+    Same loss as get_dice_loss (2D), computed for each sample of the batch instead of over the whole batch
+    :return: dice loss of each sample, shape (batch,)
+    """
+    smooth = 1.
+    target = tf.cast(target, tf.float32)
+    output = tf.cast(output, tf.float32)
+    start = 0 if use_background else 1
+    intersection = tf.reduce_sum(output[..., start:nb_classes] * target[..., start:nb_classes], axis=[1, 2])
+    union = tf.reduce_sum(output[..., start:nb_classes] ** 2, axis=[1, 2]) + \
+        tf.reduce_sum(target[..., start:nb_classes] ** 2, axis=[1, 2])
+    dice = tf.reduce_mean((2. * intersection + smooth) / (union + smooth), axis=-1)
+    return 1. - dice
@@ -0,0 +1,151 @@
+"""
+Patch manifest. An SQLite table with one row per patch (path, set, class folder, source, cohort, tissue fraction and
+number of pixels of each label), written incrementally by the dataset builders. Loading the manifest replaces listing
+all dataset folders at every start of train.py, which is slow for large datasets on network storage.
+"""
+import sqlite3
+import numpy as np
+
+
+MANIFEST_NAME = "manifest.sqlite"
+
+
+class PatchManifest:
+    """
+    Incremental writer of a patch manifest, rows are committed every commit_every patches and when closed
+    """
+    def __init__(self, path, commit_every=256):
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS patches (path TEXT PRIMARY KEY, set_name TEXT, "
+                                "class_name TEXT, source TEXT, cohort TEXT, tissue REAL, class_pixels TEXT)")
+        # manifests written before class pixel counts were stored
+        columns = [x[1] for x in self.connection.execute("PRAGMA table_info(patches)").fetchall()]
+        if "class_pixels" not in columns:
+            self.connection.execute("ALTER TABLE patches ADD COLUMN class_pixels TEXT")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS patches_set_class ON patches (set_name, class_name)")
+        self.connection.commit()
+        self.commit_every = commit_every
+        self.pending = 0
+
+    def add(self, path, set_name, class_name="", source="", cohort="", tissue=None, class_pixels=None):
+        """
+        :param path: path to .h5 patch or shard reference
+        :param set_name: ds_train or ds_val
+        :param class_name: class folder of patch, ex: invasive, benign, inSitu. Empty for single class datasets
+        :param source: where the patch comes from, ex: tma or wsi
+        :param cohort: cohort or slide the patch comes from
+        :param tissue: fraction of patch covered by tissue
+        :param class_pixels: number of pixels of each label (background first), see count_class_pixels
+        """
+        if class_pixels is not None:
+            class_pixels = ",".join(str(int(x)) for x in class_pixels)
+        self.connection.execute("INSERT OR REPLACE INTO patches (path, set_name, class_name, source, cohort, tissue, "
+                                "class_pixels) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                (path, set_name.strip("/"), class_name.strip("/"), source, cohort, tissue,
+                                 class_pixels))
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+
+def count_class_pixels(gt, nb_classes=None):
+    """
+    :param gt: gt patch, either one-hot or label map
+    :param nb_classes: number of labels, including background. Number of channels of one-hot gt if None
+    :return: number of pixels of each label
+    """
+    if gt.ndim == 3:
+        nb_classes = nb_classes or gt.shape[-1]
+        gt = np.argmax(gt, axis=-1)
+    return np.bincount(gt.ravel().astype("int64"), minlength=nb_classes or 1)
+
+
+def load_manifest(manifest_paths, set_name):
+    """
+    Load patch paths of one set from one or more manifests (ex: TMA and WSI datasets)
+    :param manifest_paths: list of paths to manifests
+    :param set_name: ds_train or ds_val
+    :return: dict with list of patch paths for each class folder, sorted by class name
+    """
+    paths = {}
+    for manifest_path in manifest_paths:
+        connection = sqlite3.connect(manifest_path)
+        rows = connection.execute("SELECT class_name, path FROM patches WHERE set_name = ?", (set_name,)).fetchall()
+        connection.close()
+        for class_name, path in rows:
+            paths.setdefault(class_name, []).append(path)
+    return dict(sorted(paths.items()))
+
+
+def load_manifest_sources(manifest_paths, set_name, key="source"):
+    """
+    Load patch paths of one set from one or more manifests, grouped by source
+    :param manifest_paths: list of paths to manifests
+    :param set_name: ds_train or ds_val
+    :param key: column to group patches by, "source" (ex: tma, wsi) or "cohort"
+    :return: dict with, for each source, a dict with list of patch paths for each class folder
+    """
+    if key not in ["source", "cohort"]:
+        raise ValueError("Unknown source key: " + key + ". Choose either 'source' or 'cohort'.")
+    sources = {}
+    for manifest_path in manifest_paths:
+        connection = sqlite3.connect(manifest_path)
+        rows = connection.execute("SELECT " + key + ", class_name, path FROM patches WHERE set_name = ?",
+                                  (set_name,)).fetchall()
+        connection.close()
+        for source, class_name, path in rows:
+            sources.setdefault(source, {}).setdefault(class_name, []).append(path)
+    return {source: dict(sorted(classes.items())) for source, classes in sorted(sources.items())}
+
+
+def load_patch_stats(manifest_paths, set_name):
+    """
+    Load per-patch statistics of one set from one or more manifests
+    :param manifest_paths: list of paths to manifests
+    :param set_name: ds_train or ds_val
+    :return: dict with (tissue fraction, class pixel counts) for each patch path, None where not stored
+    """
+    stats = {}
+    for manifest_path in manifest_paths:
+        connection = sqlite3.connect(manifest_path)
+        rows = connection.execute("SELECT path, tissue, class_pixels FROM patches WHERE set_name = ?",
+                                  (set_name,)).fetchall()
+        connection.close()
+        for path, tissue, class_pixels in rows:
+            if class_pixels is not None:
+                class_pixels = np.array([int(x) for x in class_pixels.split(",")])
+            stats[path] = (tissue, class_pixels)
+    return stats
+
+
+def sampling_weights(paths, stats, tissue_power=0., min_tissue=0., label_power=0.):
+    """
+    Weight of each patch when drawing patches, from its statistics in the manifest. Patches without statistics get
+    the weight of a patch fully covered by tissue and labels
+    :param paths: list of patch paths
+    :param stats: dict from load_patch_stats
+    :param tissue_power: weight patches by tissue fraction to this power, 0 to ignore tissue fraction
+    :param min_tissue: patches with a smaller tissue fraction are never drawn (weight 0)
+    :param label_power: weight patches by fraction of pixels with a label other than background to this power
+    :return: array of weights
+    """
+    weights = np.ones(len(paths))
+    for i, path in enumerate(paths):
+        tissue, class_pixels = stats.get(path, (None, None))
+        if tissue is not None:
+            if tissue < min_tissue:
+                weights[i] = 0
+                continue
+            weights[i] *= tissue ** tissue_power
+        if class_pixels is not None and label_power != 0:
+            # small floor, so patches without labelled pixels are still drawn once in a while
+            weights[i] *= max(1 - class_pixels[0] / max(np.sum(class_pixels), 1), 1e-3) ** label_power
+    return weights
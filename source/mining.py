@@ -0,0 +1,138 @@
+"""
+Hard patch mining. The dice loss of every train patch is recorded in a score table while training (exponential
+moving average over the times the patch is drawn), and patches are drawn in proportion to their score, so patches
+that are not learned yet are drawn more often than the ones that are. How much more (or less) often a patch is drawn
+than uniformly is capped by max_ratio (and 1 / max_ratio).
+"""
+import tensorflow as tf
+from tensorflow.keras.layers import Input, Activation, Layer
+from tensorflow.keras.models import Model
+from source.losses import per_sample_dice_loss
+
+
+class HardPatchMiner:
+    """
+    Score table of all train patches. Each class of patches is drawn from its own range of the table (see allocate)
+    """
+    def __init__(self, decay=0.9, max_ratio=4.):
+        """
+        :param decay: weight of the previous score when the score of a patch is updated with a new loss
+        :param max_ratio: a patch is drawn at most max_ratio (and at least 1 / max_ratio) times as often as uniformly
+        """
+        self.decay = decay
+        self.max_ratio = max_ratio
+        self.scores = None
+        self.size = 0
+
+    def build(self, nb_patches):
+        """
+        Create the score table, all patches start with the maximum loss (drawn uniformly until seen). A table already
+        built for the same number of patches is kept, and allocated again from the start (ex: train pipeline created
+        again for each phase of a progressive resolution schedule)
+        :param nb_patches: number of train patches
+        """
+        if self.scores is None or self.scores.shape[0] != nb_patches:
+            self.scores = tf.Variable(tf.ones(nb_patches), trainable=False, name="patch_scores")
+        self.size = 0
+
+    def allocate(self, nb_patches):
+        """
+        :param nb_patches: number of patches in a class
+        :return: index of the first patch of the class in the score table
+        """
+        if self.scores is None or self.size + nb_patches > self.scores.shape[0]:
+            raise ValueError("Score table too small, call build with the total number of train patches first.")
+        offset = self.size
+        self.size += nb_patches
+        return offset
+
+    def ratios(self, offset, nb_patches):
+        """
+        :return: how many times as often as uniformly each patch of the range should be drawn
+        """
+        scores = self.scores[offset:offset + nb_patches]
+        ratios = scores / (tf.reduce_mean(scores) + 1e-6)
+        return tf.clip_by_value(ratios, 1. / self.max_ratio, self.max_ratio)
+
+    def update(self, index, loss):
+        """
+        :param index: score table index of each sample of the batch, samples with negative index are skipped
+        :param loss: loss of each sample of the batch
+        :return: update op
+        """
+        # skipped samples add 0 instead of being masked out (fixed shapes, so the update can be compiled with XLA)
+        valid = index >= 0
+        index = tf.cast(tf.maximum(index, 0), tf.int32)
+        delta = (1. - self.decay) * (tf.cast(loss, tf.float32) - tf.gather(self.scores, index))
+        return self.scores.scatter_nd_add(index[:, tf.newaxis], tf.where(valid, delta, 0.))
+
+    def stats(self):
+        scores = self.scores.numpy()
+        return {"mining_score_mean": float(scores.mean()), "mining_score_max": float(scores.max()),
+                "mining_seen_fraction": float((scores < 1).mean())}
+
+
+def mined_path_dataset(paths, miner, weights=None, seed=None):
+    """
+    Infinite dataset of patch paths drawn with replacement in proportion to their current mining score
+    :param paths: list of patch paths of one class
+    :param miner: HardPatchMiner, the paths get their own range of its score table
+    :param weights: static sampling weight of each path (ex: from source.manifest.sampling_weights), multiplied with
+        the score ratios. None for uniform
+    :param seed: sampling seed
+    :return: dataset of paths and score table indices
+    """
+    offset = miner.allocate(len(paths))
+    weights = tf.constant([1.] * len(paths) if weights is None else weights, dtype=tf.float32)
+    paths = tf.constant(paths, dtype=tf.string)
+    last = len(weights) - 1
+
+    def draw(x):
+        # scores change while training, the cumulative weights are computed for every draw
+        cdf = tf.cumsum(miner.ratios(offset, last + 1) * weights)
+        u = tf.cast(x % (2 ** 32), tf.float32) / 2 ** 32 * cdf[-1]
+        index = tf.minimum(tf.searchsorted(cdf, u[tf.newaxis], side="right")[0], last)
+        return tf.gather(paths, index), tf.cast(offset + index, tf.int64)
+
+    return tf.data.Dataset.random(seed=seed).map(draw)
+
+
+class HardPatchMining(Layer):
+    """
+    Records the per-sample dice loss of the full resolution output in the score table of the miner. Returns the
+    output unchanged
+    """
+    def __init__(self, miner, nb_classes, **kwargs):
+        super().__init__(**kwargs)
+        self.miner = miner
+        self.nb_classes = nb_classes
+
+    def call(self, inputs):
+        output, target, index = inputs
+        update = self.miner.update(index, per_sample_dice_loss(target, output, self.nb_classes))
+        with tf.control_dependencies([update]):
+            return tf.identity(output)
+
+
+def add_hard_patch_mining(model, miner, nb_classes):
+    """
+    Wrap a model to record per-sample losses in the miner while training. The wrapped model takes the image, the
+    full resolution gt and the score table index of each sample (negative to skip, ex: for val) as inputs. The outputs
+    keep the names of the model outputs (and therefore the loss/metric names)
+    :param model: keras model
+    :param miner: HardPatchMiner
+    :param nb_classes: number of classes, including background
+    :return: keras model
+    """
+    image = Input(shape=model.input_shape[1:], dtype=model.input.dtype)
+    target = Input(shape=model.output_shape[0][1:] if isinstance(model.output_shape, list) else
+                   model.output_shape[1:])
+    index = Input(shape=(), dtype=tf.int64)
+    outputs = model(image)
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    # float32 layer, not autocast to the compute dtype of a mixed precision policy: the float32 output passes through
+    # unchanged and the losses recorded by the miner are computed in float32
+    outputs = [HardPatchMining(miner, nb_classes, dtype=tf.float32)([outputs[0], target, index])] + list(outputs[1:])
+    outputs = [Activation("linear", dtype=tf.float32, name=name)(x) for name, x in zip(model.output_names, outputs)]
+    return Model(inputs=[image, target, index], outputs=outputs if len(outputs) > 1 else outputs[0])
@@ -8,7 +8,7 @@ Some minor changed made (and removed unused code)
 
 from tensorflow.keras.layers import Input, Convolution2D, MaxPooling2D, SpatialDropout2D, \
     Activation, AveragePooling2D, BatchNormalization, TimeDistributed, Concatenate, Conv2DTranspose, \
-    UpSampling2D, multiply, Reshape, Layer
+    UpSampling2D, multiply, Reshape, Layer, Rescaling
 from tensorflow.keras.models import Model
 import tensorflow as tf
 from gradient_accumulator import AccumBatchNormalization
@@ -94,9 +94,22 @@ def encoder_block_pyramid(x, input_ds, nr_of_convolutions, accum_steps=None, use
     return x, x_before_downsampling
 
 
+def nearest_upsampling(x):
+    """
+    Same as UpSampling2D((2, 2)), with concatenations and reshapes only. The gradient of UpSampling2D
+    (ResizeNearestNeighborGrad) can not be compiled with XLA
+    """
+    height, width, channels = x.shape[1:]
+    x = Reshape((height, 2 * width, channels))(Concatenate(axis=-1)([x, x]))  # repeat columns
+    return Reshape((2 * height, 2 * width, channels))(Concatenate(axis=2)([x, x]))  # repeat rows
+
+
 def decoder_block(x, cross_over_connection, nr_of_convolutions, accum_steps=None, use_bn=False, spatial_dropout=None,
-                  renorm=False, use_grad_accum=False):
-    x = UpSampling2D((2, 2))(x)  # See if this helps with checkerboard pattern sometimes seen
+                  renorm=False, use_grad_accum=False, xla=False):
+    if xla:
+        x = nearest_upsampling(x)
+    else:
+        x = UpSampling2D((2, 2))(x)  # See if this helps with checkerboard pattern sometimes seen
     if use_bn:
         x = BatchNormalization(renorm=renorm)(x)
     if use_grad_accum:
@@ -110,10 +123,70 @@ def decoder_block(x, cross_over_connection, nr_of_convolutions, accum_steps=None
     return x
 
 
+class RecomputeGrad(Layer):
+    """
+    Calls a block (keras model) without keeping its intermediate activations for the backward pass, they are
+    recomputed from the block inputs when computing the gradients (gradient checkpointing). Costs an extra forward
+    pass of the block in each train step. The state updated by the recomputation (batch normalization statistics) is
+    restored, so it is updated once per step as without checkpointing
+    """
+    def __init__(self, block, **kwargs):
+        super().__init__(**kwargs)
+        self.block = block
+
+    def call(self, inputs, training=None):
+        inputs = list(inputs) if isinstance(inputs, (list, tuple)) else [inputs]
+        calls = []
+
+        @tf.recompute_grad
+        def forward(*x):
+            # called for the forward pass, then again to recompute it when computing the gradients
+            recompute = len(calls) > 0
+            calls.append(recompute)
+            states = [tf.identity(v) for v in self.block.non_trainable_variables] if recompute else []
+            outputs = self.block(list(x) if len(x) > 1 else x[0], training=training)
+            if recompute:
+                # undo the second update of the batch normalization statistics
+                with tf.control_dependencies(tf.nest.flatten(outputs)):
+                    restores = [v.assign(state) for v, state in zip(self.block.non_trainable_variables, states)]
+                with tf.control_dependencies(restores):
+                    outputs = tf.nest.map_structure(tf.identity, outputs)
+            return outputs
+
+        return forward(*inputs)
+
+    def get_config(self):
+        config = super().get_config()
+        config["block"] = tf.keras.layers.serialize(self.block)
+        return config
+
+    @classmethod
+    def from_config(cls, config, custom_objects=None):
+        block = tf.keras.layers.deserialize(config.pop("block"), custom_objects=custom_objects)
+        return cls(block, **config)
+
+
+def checkpointed_block(block, inputs, **kwargs):
+    """
+    Build a block as a model and call it with gradient checkpointing (see RecomputeGrad)
+    :param block: block function (ex: encoder_block), taking the inputs as first arguments
+    :param inputs: list of keras tensors
+    :param kwargs: passed on to block
+    :return: outputs of block
+    """
+    block_inputs = [Input(shape=x.shape[1:], dtype=x.dtype) for x in inputs]
+    outputs = RecomputeGrad(Model(inputs=block_inputs, outputs=block(*block_inputs, **kwargs)))(
+        inputs if len(inputs) > 1 else inputs[0])
+    return tuple(outputs) if isinstance(outputs, (list, tuple)) else outputs
+
+
 class AttentionUnet:
     def __init__(self, input_shape, nb_classes, encoder_spatial_dropout, decoder_spatial_dropout, accum_steps,
                  deep_supervision=False, input_pyramid=False, grad_accum=False, encoder_use_bn=False,
-                 decoder_use_bn=False):
+                 decoder_use_bn=False, xla=False, checkpointing=False):
+        if checkpointing and (encoder_spatial_dropout or decoder_spatial_dropout):
+            # the recomputed forward pass would draw other dropout masks
+            raise ValueError('Gradient checkpointing is not supported with spatial dropout')
         if len(input_shape) != 3 and len(input_shape) != 4:
             raise ValueError('Input shape must have 3 or 4 dimensions')
         if nb_classes <= 1:
@@ -131,6 +204,9 @@ class AttentionUnet:
         self.renorm = False
         self.grad_accum = grad_accum
         self.accum_steps = accum_steps
+        self.xla = xla  # build with layers that can be compiled with XLA
+        # recompute the activations of the encoder/decoder blocks in the backward pass instead of keeping them
+        self.checkpointing = checkpointing
 
     def set_renorm(self, value):
         self.renorm = value
@@ -138,6 +214,14 @@ class AttentionUnet:
     def set_convolutions(self, convolutions):
         self.convolutions = convolutions
 
+    def block(self, block, inputs, **kwargs):
+        """
+        Call block on inputs (list of keras tensors), with gradient checkpointing if enabled
+        """
+        if self.checkpointing:
+            return checkpointed_block(block, inputs, **kwargs)
+        return block(*inputs, **kwargs)
+
 
     def create(self):
         """
@@ -159,19 +243,19 @@ class AttentionUnet:
 
         for i, nbc in enumerate(self.convolutions[:-1]):
             if not self.input_pyramid or (i == 0):
-                x, x_before_ds = encoder_block(x, nbc, accum_steps=self.accum_steps, use_bn=self.encoder_use_bn,
-                                               spatial_dropout=self.encoder_spatial_dropout, renorm=self.renorm,
-                                               use_grad_accum=self.grad_accum)
+                x, x_before_ds = self.block(encoder_block, [x], nr_of_convolutions=nbc, accum_steps=self.accum_steps,
+                                            use_bn=self.encoder_use_bn, spatial_dropout=self.encoder_spatial_dropout,
+                                            renorm=self.renorm, use_grad_accum=self.grad_accum)
             else:
-                x, x_before_ds = encoder_block_pyramid(x, scaled_input[i], nbc, accum_steps=self.accum_steps,
-                                                       use_bn=self.encoder_use_bn,
-                                                       spatial_dropout=self.encoder_spatial_dropout, renorm=self.renorm,
-                                                       use_grad_accum=self.grad_accum)
+                x, x_before_ds = self.block(encoder_block_pyramid, [x, scaled_input[i]], nr_of_convolutions=nbc,
+                                            accum_steps=self.accum_steps, use_bn=self.encoder_use_bn,
+                                            spatial_dropout=self.encoder_spatial_dropout, renorm=self.renorm,
+                                            use_grad_accum=self.grad_accum)
             connection.insert(0, x_before_ds)  # Append in reverse order for easier use in the next block
 
-        x = convolution_block(x, self.convolutions[-1], accum_steps=self.accum_steps,
-                              use_bn=self.encoder_use_bn, spatial_dropout=self.encoder_spatial_dropout,
-                              renorm=self.renorm, use_grad_accum=self.grad_accum)
+        x = self.block(convolution_block, [x], nr_of_convolutions=self.convolutions[-1], accum_steps=self.accum_steps,
+                       use_bn=self.encoder_use_bn, spatial_dropout=self.encoder_spatial_dropout,
+                       renorm=self.renorm, use_grad_accum=self.grad_accum)
         connection.insert(0, x)
 
         inverse_conv = self.convolutions[::-1]
@@ -180,11 +264,12 @@ class AttentionUnet:
         # @TODO. Should Attention Gating be done over the last feature map (i.e. image at the highest resolution)?
         # Some papers say they don't because the feature map does not represent the data in a high dimensional space.
         for i, nbc in enumerate(inverse_conv):
-            x = decoder_block(x, connection[i + 1], nbc, self.accum_steps, use_bn=self.decoder_use_bn,
-                              spatial_dropout=self.decoder_spatial_dropout, renorm=self.renorm,
-                              use_grad_accum=self.grad_accum)
+            x = self.block(decoder_block, [x, connection[i + 1]], nr_of_convolutions=nbc, accum_steps=self.accum_steps,
+                           use_bn=self.decoder_use_bn, spatial_dropout=self.decoder_spatial_dropout,
+                           renorm=self.renorm, use_grad_accum=self.grad_accum, xla=self.xla)
             decoded_layers.append(x)
 
+        # the softmax heads stay float32 with mixed precision (float16 or bfloat16), so do the dice losses on them
         if not self.deep_supervision:
             # Final activation layer
             x = Convolution2D(self.nb_classes, 1, activation='softmax', dtype=tf.float32)(x)
@@ -196,3 +281,29 @@ class AttentionUnet:
             x = recons_list[::-1]
 
         return Model(inputs=input_layer, outputs=x)
+
+
+def add_rescaling(model, scale):
+    """
+    Wrap a float model (ex: AttentionUnet or deep_learning_tools Unet) to take uint8 input, rescaled in the model.
+    Outputs keep the names of the float model outputs (and therefore the loss/metric names). The float model is kept
+    as a layer sharing the weights, see remove_rescaling
+    :param model: keras model taking float input
+    :param scale: rescaling factor, ex: 1 / 255
+    :return: keras model taking uint8 input
+    """
+    input_layer = Input(shape=model.input_shape[1:], dtype=tf.uint8)
+    outputs = model(Rescaling(scale)(input_layer))
+    if not isinstance(outputs, (list, tuple)):
+        outputs = [outputs]
+    outputs = [Activation("linear", dtype=tf.float32, name=name)(x) for name, x in zip(model.output_names, outputs)]
+    return Model(inputs=input_layer, outputs=outputs if len(outputs) > 1 else outputs[0])
+
+
+def remove_rescaling(model):
+    """
+    :param model: model created with add_rescaling
+    :return: the wrapped float model, sharing weights with model, ex: to export to ONNX for FastPathology, which
+        rescales the input itself (scale-factor 0.00392156862)
+    """
+    return [layer for layer in model.layers if isinstance(layer, Model)][0]
@@ -0,0 +1,183 @@
+"""
+Reading stored patches (.h5 files, shards and cores) with the patch caches, with numpy and h5py only. No TensorFlow,
+so that the worker processes of source.loader import it without the cost of starting TensorFlow
+"""
+import hashlib
+import os
+import shutil
+import threading
+from collections import OrderedDict
+import h5py
+import numpy as np
+from source.shards import ShardReader, is_shard_ref
+from source.cores import is_core, random_core_crop
+
+
+# shard handles are kept open for the lifetime of the process
+_shard_reader = ShardReader()
+
+
+class PatchCache:
+    """
+    In-memory LRU cache of patches as stored (uint8 image, gt), keyed by path. The least recently used patches are
+    evicted when the cached patches take more than max_bytes. Shared between the tf.data reader threads
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.patches = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            patch = self.patches.get(path)
+            if patch is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.patches.move_to_end(path)
+            return patch
+
+    def put(self, path, image, gt):
+        size = image.nbytes + gt.nbytes
+        if size > self.max_bytes:
+            return
+        # cached arrays are shared between reads, make sure nobody modifies them in-place
+        image.setflags(write=False)
+        gt.setflags(write=False)
+        with self.lock:
+            if path in self.patches:
+                return
+            self.patches[path] = (image, gt)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (old_image, old_gt) = self.patches.popitem(last=False)
+                self.nbytes -= old_image.nbytes + old_gt.nbytes
+
+    def stats(self):
+        with self.lock:
+            return {"cache_hits": self.hits, "cache_misses": self.misses,
+                    "cache_hit_rate": self.hits / max(self.hits + self.misses, 1),
+                    "cache_size_gb": self.nbytes / 1024 ** 3, "cache_patches": len(self.patches)}
+
+
+class SharedPatchCache:
+    """
+    Patch cache shared between processes on the same node (ex: several train.py runs on the same dataset), stored as
+    .npy files in a RAM-backed directory (ex: /dev/shm/). Cached patches are memory-mapped when read, so all processes
+    share one copy in RAM. Files are written to a temporary name and renamed, so a patch is never read half written.
+    Nothing is evicted, patches are no longer added when less than min_free_gb is left. Remove the directory when
+    the runs are done
+    """
+    def __init__(self, dir_path, min_free_gb=1):
+        self.dir_path = dir_path.rstrip("/") + "/"
+        self.min_free_bytes = int(min_free_gb * 1024 ** 3)
+        self.full = False
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.dir_path, exist_ok=True)
+
+    def key(self, path):
+        return self.dir_path + hashlib.sha1(path.encode("utf-8")).hexdigest()
+
+    def get(self, path):
+        key = self.key(path)
+        # input is renamed last, if it exists the whole patch is there
+        if not os.path.exists(key + ".input.npy"):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return np.load(key + ".input.npy", mmap_mode="r"), np.load(key + ".output.npy", mmap_mode="r")
+
+    def put(self, path, image, gt):
+        if self.full:
+            return False
+        if shutil.disk_usage(self.dir_path).free - image.nbytes - gt.nbytes < self.min_free_bytes:
+            self.full = True
+            print("Shared patch cache " + self.dir_path + " is full, new patches are not cached.")
+            return False
+        key = self.key(path)
+        tmp = "." + str(os.getpid()) + "_" + str(threading.get_ident()) + ".tmp.npy"
+        for suffix, array in [(".output.npy", gt), (".input.npy", image)]:
+            np.save(key + tmp, array)
+            os.replace(key + tmp, key + suffix)
+        return True
+
+    def stats(self):
+        return {"shm_cache_hits": self.hits, "shm_cache_misses": self.misses,
+                "shm_cache_hit_rate": self.hits / max(self.hits + self.misses, 1)}
+
+
+# disabled until enable_patch_cache/enable_shared_patch_cache is called
+_patch_cache = None
+_shared_patch_cache = None
+
+
+def enable_patch_cache(max_gb):
+    """
+    Cache all patches read with read_patch (and patchReader/labelmapReader) in RAM
+    :param max_gb: RAM budget of cache in GB
+    :return: the cache
+    """
+    global _patch_cache
+    _patch_cache = PatchCache(int(max_gb * 1024 ** 3))
+    return _patch_cache
+
+
+def enable_shared_patch_cache(dir_path, min_free_gb=1):
+    """
+    Cache all patches read with read_patch in a directory shared with other processes, checked before the disk
+    :param dir_path: RAM-backed directory, ex: /dev/shm/epithelium_cache/
+    :param min_free_gb: stop adding patches when less than this is free in dir_path
+    :return: the cache
+    """
+    global _shared_patch_cache
+    _shared_patch_cache = SharedPatchCache(dir_path, min_free_gb)
+    return _shared_patch_cache
+
+
+def read_patch(path):
+    """
+    Read image and gt as stored, either from a single patch file or from a shard. Served from RAM if a patch cache
+    is enabled and the patch has been read before (by this process, or by any process for the shared cache)
+    :param path: path to .h5 patch or shard reference
+    :return: image and gt
+    """
+    if _patch_cache is not None:
+        patch = _patch_cache.get(path)
+        if patch is not None:
+            return patch
+    if _shared_patch_cache is not None:
+        patch = _shared_patch_cache.get(path)
+        if patch is not None:
+            return patch
+    if is_shard_ref(path):
+        image, gt = _shard_reader.read(path)
+    else:
+        with h5py.File(path, "r") as f:
+            image = np.asarray(f["input"])
+            gt = np.asarray(f["output"])
+    # patches in the shared cache are already in RAM, only keep a private copy if they could not be shared
+    if _shared_patch_cache is not None and _shared_patch_cache.put(path, image, gt):
+        return image, gt
+    if _patch_cache is not None:
+        _patch_cache.put(path, image, gt)
+    return image, gt
+
+
+def read_labelmap(path, as_uint8=False, crop_size=1024, min_tissue=0., seed=None):
+    """
+    Read image and gt as uint8 label map, patches stored as one-hot are converted. Stored cores are randomly cropped
+    to crop_size, with at least min_tissue tissue if possible (crop seeded by seed). Used by labelmapReader, and
+    outside of tf.data by the worker processes of source.loader
+    """
+    image, gt = read_patch(path)
+    if is_core(path):
+        image, gt = random_core_crop(image, gt, crop_size, min_tissue, seed=seed)
+    image = image.astype("uint8" if as_uint8 else "float32")
+    if gt.ndim == 3:  # stored as one-hot
+        gt = np.argmax(gt, axis=-1)
+    gt = gt.astype("uint8")
+    return image, gt
@@ -0,0 +1,147 @@
+"""
+TFRecord patch storage. Patches are stored as raw uint8 bytes (image and label map) with a fixed shape, so they can be
+decoded natively in the tf.data graph (no tf.py_function), which lets decoding scale across all available cores.
+"""
+import os
+import numpy as np
+import tensorflow as tf
+from source.utils import read_patch, list_patch_paths
+from source.cores import is_core
+
+
+RECORD_SUFFIX = ".tfrecord"
+
+
+def serialize_patch(image, gt):
+    """
+    :param image: uint8 image patch
+    :param gt: gt patch, either one-hot or label map (always stored as uint8 label map)
+    :return: serialized tf.train.Example
+    """
+    if gt.ndim == 3:
+        gt = np.argmax(gt, axis=-1)
+    feature = {
+        "input": tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.astype("uint8").tobytes()])),
+        "output": tf.train.Feature(bytes_list=tf.train.BytesList(value=[gt.astype("uint8").tobytes()])),
+        "shape": tf.train.Feature(int64_list=tf.train.Int64List(value=list(image.shape))),
+    }
+    return tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString()
+
+
+def parse_patch(serialized, img_size, channels=3, as_uint8=False):
+    """
+    Decode serialized patch in the tf.data graph
+    :param serialized: serialized tf.train.Example
+    :param img_size: height and width of patch
+    :param channels: number of image channels
+    :param as_uint8: return image as uint8 instead of float32
+    :return: float32 (or uint8) image and uint8 label map, same as source.utils.labelmapReader
+    """
+    features = tf.io.parse_single_example(serialized, {
+        "input": tf.io.FixedLenFeature([], tf.string),
+        "output": tf.io.FixedLenFeature([], tf.string),
+    })
+    image = tf.reshape(tf.io.decode_raw(features["input"], tf.uint8), [img_size, img_size, channels])
+    gt = tf.reshape(tf.io.decode_raw(features["output"], tf.uint8), [img_size, img_size])
+    return (image if as_uint8 else tf.cast(image, tf.float32)), gt
+
+
+def export_to_tfrecords(paths, prefix, patches_per_file=256):
+    """
+    Write patches to TFRecord files named <prefix>_<file number>.tfrecord
+    :param paths: list of .h5 patch paths (or shard references)
+    :param prefix: output prefix, including directory
+    :param patches_per_file: number of patches in each TFRecord file
+    :return: list of written files
+    """
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    files = []
+    writer = None
+    for i, path in enumerate(paths):
+        if is_core(path):
+            raise ValueError("Stored cores can not be converted to TFRecords, patches are cropped from cores when "
+                             "training: " + path)
+        if i % patches_per_file == 0:
+            if writer is not None:
+                writer.close()
+            files.append(prefix + "_" + str(len(files)) + RECORD_SUFFIX)
+            writer = tf.io.TFRecordWriter(files[-1])
+        image, gt = read_patch(path)
+        writer.write(serialize_patch(image, gt))
+    if writer is not None:
+        writer.close()
+    return files
+
+
+def export_directory(dir_path, out_path, patches_per_file=256):
+    """
+    Export a dataset directory (ex: ds_train/) to TFRecords, keeping the class folder structure
+    :param dir_path: path to directory with patches or class folders, ending with "/"
+    :param out_path: path to output directory, ending with "/"
+    :param patches_per_file: number of patches in each TFRecord file
+    """
+    class_dirs = [x for x in os.listdir(dir_path) if os.path.isdir(dir_path + x)]
+    if not class_dirs:
+        export_to_tfrecords(list_patch_paths(dir_path), out_path + "part", patches_per_file)
+    for class_dir in class_dirs:
+        export_to_tfrecords(list_patch_paths(dir_path + class_dir + "/"), out_path + class_dir + "/part",
+                            patches_per_file)
+
+
+def list_record_files(dir_path):
+    return [dir_path + x for x in os.listdir(dir_path) if x.endswith(RECORD_SUFFIX)]
+
+
+def list_class_record_files(dir_path):
+    """
+    :param dir_path: set directory (ex: ds_train/) containing one folder per class
+    :return: TFRecord files of all classes
+    """
+    return [x for class_dir in sorted(os.listdir(dir_path)) if os.path.isdir(dir_path + class_dir)
+            for x in list_record_files(dir_path + class_dir + "/")]
+
+
+def record_dataset(files, img_size, shuffle_buffer=64, num_parallel_calls=tf.data.AUTOTUNE, seed=None,
+                   deterministic=False, as_uint8=False):
+    """
+    Infinite, shuffled dataset of patches from TFRecord files
+    :param files: list of TFRecord files
+    :param img_size: height and width of patches
+    :param shuffle_buffer: number of patches to shuffle across (each patch takes ~4 MB serialized at 1024x1024)
+    :param num_parallel_calls: number of parallel decodes
+    :param seed: seed for file order and shuffling
+    :param deterministic: keep the order of patches fixed (given seed), at some cost in throughput
+    :param as_uint8: keep images as uint8
+    :return: dataset of float32 (or uint8) images and uint8 label maps
+    """
+    ds = tf.data.Dataset.from_tensor_slices(files)
+    ds = ds.shuffle(len(files), seed=seed, reshuffle_each_iteration=True).repeat()
+    ds = ds.interleave(tf.data.TFRecordDataset, cycle_length=min(len(files), 16),
+                       num_parallel_calls=tf.data.AUTOTUNE, deterministic=deterministic)
+    ds = ds.shuffle(shuffle_buffer, seed=seed)
+    return ds.map(lambda x: parse_patch(x, img_size, as_uint8=as_uint8), num_parallel_calls=num_parallel_calls,
+                  deterministic=deterministic)
+
+
+def class_balanced_record_dataset(dir_paths, img_size, weights=None, seed=None, **kwargs):
+    """
+    Infinite dataset drawing each patch from a class drawn with the given weights, as class_balanced_path_dataset does
+    for .h5 paths
+    :param dir_paths: list of set directories (ex: ds_train/ of TMA and WSI records), containing one folder per class
+    :param img_size: height and width of patches
+    :param weights: sampling weight of each class (sorted by class folder name), uniform if None
+    :param seed: shuffle and sampling seed
+    :param kwargs: passed on to record_dataset
+    :return: dataset of float32 images and uint8 label maps
+    """
+    class_names = sorted(set(x for dir_path in dir_paths for x in os.listdir(dir_path) if os.path.isdir(dir_path + x)))
+    datasets = []
+    for class_name in class_names:
+        files = []
+        for dir_path in dir_paths:
+            if os.path.isdir(dir_path + class_name):
+                files.extend(list_record_files(dir_path + class_name + "/"))
+        datasets.append(record_dataset(files, img_size, seed=seed, **kwargs))
+    if weights is not None:
+        weights = [w / sum(weights) for w in weights]
+    return tf.data.Dataset.sample_from_datasets(datasets, weights=weights, seed=seed)
@@ -0,0 +1,133 @@
+"""
+Sharded patch storage. Instead of one .h5 file per patch, many patches are written to a single HDF5 file (a shard),
+together with an index of patch names, classes and coordinates. Each patch is stored as its own chunk, so reading a
+patch from an open shard costs one chunk read.
+A patch inside a shard is referenced by the string "<shard path>#<index>", which can be used anywhere a patch path is
+expected (e.g. by source.utils.patchReader).
+"""
+import os
+import threading
+from collections import OrderedDict
+import h5py
+
+
+SHARD_SUFFIX = ".shard.h5"
+REF_SEPARATOR = "#"
+
+
+def is_shard_ref(path):
+    return REF_SEPARATOR in path
+
+
+def split_shard_ref(ref):
+    """
+    :param ref: patch reference, "<shard path>#<index>"
+    :return: shard path and index of the patch within the shard
+    """
+    path, idx = ref.rsplit(REF_SEPARATOR, 1)
+    return path, int(idx)
+
+
+def list_shard_refs(path):
+    """
+    :param path: path to shard
+    :return: list of references to all patches in the shard
+    """
+    with h5py.File(path, "r") as f:
+        nb_patches = f["input"].shape[0]
+    return [path + REF_SEPARATOR + str(i) for i in range(nb_patches)]
+
+
+class ShardWriter:
+    """
+    Writes patches to a sequence of shards named <prefix>_<shard number>.shard.h5. A new shard is started every
+    shard_size patches, to keep single files at a manageable size.
+    """
+    def __init__(self, prefix, shard_size=256, compression=None):
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self.compression = compression
+        self.shard_idx = 0
+        self.count = 0  # number of patches in current shard
+        self.file = None
+
+    def _open(self, image, gt, nb_coords):
+        os.makedirs(os.path.dirname(self.prefix), exist_ok=True)
+        self.file = h5py.File(self.prefix + "_" + str(self.shard_idx) + SHARD_SUFFIX, "w")
+        for name, data in [("input", image), ("output", gt)]:
+            self.file.create_dataset(name=name, shape=(0,) + data.shape, maxshape=(None,) + data.shape,
+                                     dtype=data.dtype, chunks=(1,) + data.shape, compression=self.compression)
+        self.file.create_dataset(name="names", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=True)
+        self.file.create_dataset(name="classes", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=True)
+        self.file.create_dataset(name="coords", shape=(0, nb_coords), maxshape=(None, nb_coords), dtype="int64",
+                                 chunks=True)
+        self.count = 0
+
+    def write(self, image, gt, name="", class_name="", coords=()):
+        """
+        Append patch to current shard
+        :param image: image patch
+        :param gt: ground truth patch
+        :param name: patch name (what the file would have been called when storing one file per patch)
+        :param class_name: class folder of patch, ex: invasive, benign, inSitu
+        :param coords: tuple of ints locating the patch, ex: (wsi_idx, tma_idx, patch_idx)
+        :return: reference to the written patch
+        """
+        if self.file is None:
+            self._open(image, gt, len(coords))
+
+        idx = self.count
+        for key, data in [("input", image), ("output", gt), ("names", name), ("classes", class_name),
+                          ("coords", coords)]:
+            self.file[key].resize(idx + 1, axis=0)
+            self.file[key][idx] = data
+        self.count += 1
+        ref = self.file.filename + REF_SEPARATOR + str(idx)
+
+        if self.count == self.shard_size:
+            self.close()
+            self.shard_idx += 1
+        return ref
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class ShardReader:
+    """
+    Reads patches from shards. Shard handles are kept open between reads (up to max_open shards, least recently
+    used shards are closed first), so that each patch costs one chunk read instead of one file open.
+    """
+    def __init__(self, max_open=512):
+        self.max_open = max_open
+        self.files = OrderedDict()
+        self.lock = threading.Lock()  # patchReader may be called from several tf.data threads
+
+    def _get_file(self, path):
+        if path in self.files:
+            self.files.move_to_end(path)
+        else:
+            if len(self.files) >= self.max_open:
+                _, oldest = self.files.popitem(last=False)
+                oldest.close()
+            self.files[path] = h5py.File(path, "r")
+        return self.files[path]
+
+    def read(self, ref):
+        """
+        :param ref: patch reference, "<shard path>#<index>"
+        :return: image and gt of the patch as stored
+        """
+        path, idx = split_shard_ref(ref)
+        # h5py serializes reads anyway, holding the lock also protects shards from being closed while read
+        with self.lock:
+            f = self._get_file(path)
+            return f["input"][idx], f["output"][idx]
+
+    def close(self):
+        with self.lock:
+            for f in self.files.values():
+                f.close()
+            self.files.clear()
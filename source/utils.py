@@ -3,6 +3,76 @@ import logging as log
 import tensorflow as tf
 import tensorflow_datasets as tfds
 import h5py
+import os
+from source.shards import SHARD_SUFFIX, list_shard_refs
+from source.cores import is_core, random_core_crop
+from source.patches import PatchCache, SharedPatchCache, enable_patch_cache, enable_shared_patch_cache, read_patch, \
+    read_labelmap
+from source.mining import mined_path_dataset
+
+
+class ExportModelCheckpoint(tf.keras.callbacks.ModelCheckpoint):
+    """
+    ModelCheckpoint saving another model than the one trained, which shares its weights (ex: the float model wrapped
+    by source.networks.add_rescaling, for export), or gets them copied from weights_model before saving (ex: a
+    float32 copy of a bfloat16 model)
+    """
+    def __init__(self, export_model, *args, weights_model=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.export_model = export_model
+        self.weights_model = weights_model
+
+    def set_model(self, model):
+        super().set_model(self.export_model)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.weights_model is not None:
+            self.export_model.set_weights(self.weights_model.get_weights())
+        super().on_epoch_end(epoch, logs)
+
+
+class SourceCounter:
+    """
+    Number of patches drawn from each source (ex: tma, wsi), counted in the tf.data graph
+    """
+    def __init__(self, names):
+        self.names = list(names)
+        self.counts = tf.Variable(tf.zeros(len(self.names), dtype=tf.int64), trainable=False)
+
+    def count(self, index, *x):
+        """
+        Count an element drawn from source index, use as dataset.map(lambda *x: counter.count(index, *x))
+        """
+        with tf.control_dependencies([self.counts.assign_add(tf.one_hot(index, len(self.names), dtype=tf.int64))]):
+            x = tuple(tf.identity(v) for v in x)
+        return x[0] if len(x) == 1 else x
+
+    def stats(self):
+        counts = self.counts.numpy()
+        total = max(int(counts.sum()), 1)
+        stats = {}
+        for name, count in zip(self.names, counts):
+            stats["source_" + name + "_patches"] = int(count)
+            stats["source_" + name + "_fraction"] = count / total
+        return stats
+
+
+class PipelineStatsLogger(tf.keras.callbacks.Callback):
+    """
+    Adds input pipeline statistics (cache hit/miss counters, patches drawn from each source) to the epoch logs. Must
+    be placed before CSVLogger/TensorBoard in the callbacks list for them to see the statistics
+    """
+    def __init__(self, *stats):
+        """
+        :param stats: objects with a stats() method returning a dict, ex: PatchCache or SourceCounter
+        """
+        super().__init__()
+        self.stats = stats
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is not None:
+            for x in self.stats:
+                logs.update(x.stats())
 
 
 # from tensorflow example, modified
@@ -11,53 +81,164 @@ def normalize_img(image, label):
     return tf.cast(image, tf.float32) / 255., label
 
 
-# Get image and gt from hdf5
-def patchReader(path):
+def list_patch_paths(dir_path):
+    """
+    List all patches in a directory, patches stored in shards are listed as "<shard path>#<index>"
+    :param dir_path: path to directory, ending with "/"
+    :return: list of patch paths
+    """
+    paths = []
+    for file_ in os.listdir(dir_path):
+        if file_.endswith(SHARD_SUFFIX):
+            paths.extend(list_shard_refs(dir_path + file_))
+        else:
+            paths.append(dir_path + file_)
+    return paths
+
+
+# Get image and gt from hdf5, image as uint8 if as_uint8 (normalized in the model)
+# Stored cores are randomly cropped to crop_size, with at least min_tissue tissue if possible (crop seeded by seed)
+def patchReader(path, nb_classes=4, as_uint8=False, crop_size=1024, min_tissue=0., seed=None):
     path = tfds.as_numpy(path).decode("utf-8")
 
-    with h5py.File(path, "r") as f:
-        image = np.asarray(f["input"]).astype("float32")
-        gt = np.asarray(f["output"]).astype("float32")
-        # TODO: cpu, gpu issue. Slow?
-        #temp_gt = np.zeros(gt.shape)  # only do if all epithlium as one class
-        #temp_gt = ((gt[:, :, 1] == 1) | (gt[:, :, 2] == 1) | (gt[:, :, 3] == 1))  # only do if all epithelium as one class
-        #gt = temp_gt  # only do if all epithelium as one class
+    image, gt = read_patch(path)
+    if is_core(path):
+        image, gt = random_core_crop(image, gt, crop_size, min_tissue, seed=_crop_seed(seed))
+    image = image.astype("uint8" if as_uint8 else "float32")
+    if gt.ndim == 2:  # stored as label map
+        gt = np.eye(nb_classes, dtype="float32")[gt]
+    gt = gt.astype("float32")
+    # TODO: cpu, gpu issue. Slow?
+    #temp_gt = np.zeros(gt.shape)  # only do if all epithlium as one class
+    #temp_gt = ((gt[:, :, 1] == 1) | (gt[:, :, 2] == 1) | (gt[:, :, 3] == 1))  # only do if all epithelium as one class
+    #gt = temp_gt  # only do if all epithelium as one class
     return image, gt
 
 
-def get_random_path_from_random_class(x1, x2, x3):
-    nested_class_folder = [x1, x2, x3]
+# Get image and gt as uint8 label map from hdf5, patches stored as one-hot are converted
+def labelmapReader(path, as_uint8=False, crop_size=1024, min_tissue=0., seed=None):
+    path = tfds.as_numpy(path).decode("utf-8")
+    return read_labelmap(path, as_uint8, crop_size, min_tissue, _crop_seed(seed))
 
-    # make infinite generator
-    while True:
-        # get random class
-        random_class_int = np.random.randint(0, len(nested_class_folder), 1)[0]
-        chosen_class = nested_class_folder[random_class_int]
 
-        # get random patch from selected class
-        random_patch = np.random.choice(chosen_class, 1)[0].decode('utf-8')
+def _crop_seed(seed):
+    # seed given as tensor to the readers in tf.py_function
+    return None if seed is None else int(seed)
 
-        # convert to tensor
-        random_patch = tf.convert_to_tensor(random_patch, dtype=tf.string)
 
-        yield random_patch
+def one_hot_labelmap(image, label, nb_classes):
+    """
+    One-hot encode label map in the tf.data graph
+    :param image: image
+    :param label: label map with class indices
+    :param nb_classes: number of classes, including background
+    :return: image and one-hot label
+    """
+    return image, tf.one_hot(tf.cast(label, tf.int32), nb_classes, dtype=tf.float32)
 
 
-# generator to use when all epithelium as one class
-def get_random_path(x1):
+def list_class_paths(dir_path):
+    """
+    :param dir_path: path to set directory (ex: ds_train/) with one folder per class, ending with "/"
+    :return: dict with list of patch paths for each class folder, sorted by class name
+    """
+    return {x: list_patch_paths(dir_path + x + "/") for x in sorted(os.listdir(dir_path)) if os.path.isdir(dir_path + x)}
 
-    # make infinite generator
-    while True:
-        # get random patch
-        random_patch = np.random.choice(x1, 1)[0].decode('utf-8')
 
-        # convert to tensor
-        random_patch = tf.convert_to_tensor(random_patch, dtype=tf.string)
+def mix_sources(datasets, weights=None, seed=None, counter=None):
+    """
+    Infinite dataset drawing each element from a source dataset drawn in the graph with the given weights
+    :param datasets: list of infinite datasets, one for each source
+    :param weights: sampling weight of each source, uniform if None
+    :param seed: sampling seed
+    :param counter: SourceCounter with the sources in the same order, counting drawn elements. Not counted if None
+    :return: dataset
+    """
+    if weights is None:
+        weights = [1.] * len(datasets)
+    if len(weights) != len(datasets):
+        raise ValueError("Got " + str(len(weights)) + " source weights for " + str(len(datasets)) + " sources.")
+    if counter is not None:
+        datasets = [ds.map(lambda *x: counter.count(i, *x)) for i, ds in enumerate(datasets)]
+    weights = [w / sum(weights) for w in weights]
+    return tf.data.Dataset.sample_from_datasets(datasets, weights=weights, seed=seed)
+
+
+def random_path_dataset(paths, seed=None):
+    """
+    Infinite dataset of patch paths, reshuffled every pass through the paths
+    :param paths: list of patch paths
+    :param seed: shuffle seed
+    :return: dataset of paths
+    """
+    ds = tf.data.Dataset.from_tensor_slices(tf.constant(paths, dtype=tf.string))
+    return ds.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True).repeat()
 
-        yield random_patch
+
+def weighted_path_dataset(paths, weights, seed=None):
+    """
+    Infinite dataset of patch paths drawn with replacement, each path with probability proportional to its weight.
+    Paths are drawn in the graph, by a binary search of a uniform draw in the cumulative weights
+    :param paths: list of patch paths
+    :param weights: sampling weight of each path (ex: from source.manifest.sampling_weights)
+    :param seed: sampling seed
+    :return: dataset of paths
+    """
+    weights = np.asarray(weights, dtype="float64")
+    if len(weights) != len(paths):
+        raise ValueError("Got " + str(len(weights)) + " weights for " + str(len(paths)) + " paths.")
+    if not np.sum(weights) > 0:
+        raise ValueError("All sampling weights are zero.")
+    cdf = tf.constant(np.cumsum(weights) / np.sum(weights), dtype=tf.float64)
+    paths = tf.constant(paths, dtype=tf.string)
+    last = len(weights) - 1
+
+    def draw(x):
+        # uniform in [0, 1) from the random int64, which holds 32 random bits
+        u = tf.cast(x % (2 ** 32), tf.float64) / 2 ** 32
+        index = tf.searchsorted(cdf, u[tf.newaxis], side="right")[0]
+        return tf.gather(paths, tf.minimum(index, last))
+
+    return tf.data.Dataset.random(seed=seed).map(draw)
+
+
+def class_balanced_path_dataset(nested_paths, weights=None, seed=None, patch_weights=None, miner=None):
+    """
+    Infinite dataset of patch paths, where the class of each path is drawn in the graph with the given weights and
+    each class is a shuffled, repeated dataset of its paths. Classes without patches are skipped
+    :param nested_paths: list of lists of paths, one list for each class
+    :param weights: sampling weight of each class, uniform if None
+    :param seed: shuffle and sampling seed
+    :param patch_weights: list of sampling weights of the paths of each class (see weighted_path_dataset). Paths are
+        drawn uniformly if None
+    :param miner: source.mining.HardPatchMiner, to draw the paths of each class by their mining score (see
+        mined_path_dataset). Not used if None
+    :return: dataset of paths, and of score table indices with miner
+    """
+    if weights is None:
+        weights = [1.] * len(nested_paths)
+    if len(weights) != len(nested_paths):
+        raise ValueError("Got " + str(len(weights)) + " class weights for " + str(len(nested_paths)) + " classes.")
+    if patch_weights is not None:
+        # classes where no patch can be drawn are skipped as well
+        nested_paths = [paths if np.sum(w) > 0 else [] for paths, w in zip(nested_paths, patch_weights)]
+    if miner is not None:
+        datasets = [mined_path_dataset(paths, miner, None if patch_weights is None else patch_weights[i], seed)
+                    for i, paths in enumerate(nested_paths) if len(paths) > 0]
+    elif patch_weights is None:
+        datasets = [random_path_dataset(paths, seed) for paths in nested_paths if len(paths) > 0]
+    else:
+        datasets = [weighted_path_dataset(paths, w, seed) for paths, w in zip(nested_paths, patch_weights)
+                    if len(paths) > 0]
+    weights = [w for w, paths in zip(weights, nested_paths) if len(paths) > 0]
+    if not datasets:
+        raise ValueError("No patches to draw from.")
+    weights = [w / sum(weights) for w in weights]
+    return tf.data.Dataset.sample_from_datasets(datasets, weights=weights, seed=seed)
 
 
 # by André Pedersen:
+# no longer used by train.py, the losses downsample the gt to the resolution of each output (see match_resolution)
 def create_multiscale_input(gt, nb_downsamples):
     hierarchical_gt = [gt, ]
     for i in range(1, nb_downsamples):
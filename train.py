@@ -1,15 +1,27 @@
 import tensorflow as tf
 import os
+import hashlib
+import json
 from deep_learning_tools.network import Unet
 from tensorflow.keras.callbacks import ModelCheckpoint, CSVLogger, EarlyStopping, TensorBoard, ReduceLROnPlateau
 from datetime import datetime, date
 from source.augment import random_brightness, random_rot90, random_flipud, \
-    random_fliplr, random_hue, random_saturation, random_shift, random_blur
+    random_fliplr, random_hue, random_saturation, random_shift, random_blur, batch_augment, element_seed, fold_seed, \
+    random_crop, center_crop
 from source.losses import get_dice_loss, class_dice_loss
-from source.networks import AttentionUnet
-from source.utils import normalize_img, patchReader, get_random_path_from_random_class, \
-     create_multiscale_input, get_random_path
-from argparse import ArgumentParser
+from source.networks import AttentionUnet, add_rescaling
+from source.utils import normalize_img, patchReader, class_balanced_path_dataset, \
+     random_path_dataset, list_patch_paths, labelmapReader, one_hot_labelmap, \
+     enable_patch_cache, enable_shared_patch_cache, PipelineStatsLogger, ExportModelCheckpoint, \
+     weighted_path_dataset, list_class_paths, mix_sources, SourceCounter
+from source.records import record_dataset, class_balanced_record_dataset, list_record_files, \
+    list_class_record_files
+from source.manifest import load_manifest, load_manifest_sources, load_patch_stats, sampling_weights
+from source.loader import SharedMemoryLoader
+from source.mining import HardPatchMiner, mined_path_dataset, add_hard_patch_mining
+from source.distribute import STRATEGIES, split_cpu, create_strategy, strategy_scope, input_context, \
+    distribute_dataset
+from argparse import ArgumentParser, Namespace
 import sys
 from gradient_accumulator import GradientAccumulateModel
 from tensorflow.keras import mixed_precision
@@ -17,185 +29,586 @@ import numpy as np
 import random as python_random
 
 
-def main(ret):
-    curr_date = "".join(date.today().strftime("%d/%m").split("/")) + date.today().strftime("%Y")[2:]
-    curr_time = "".join(str(datetime.now()).split(" ")[1].split(".")[0].split(":"))
-
-    img_size = 1024
-
-    # network stuff
-    encoder_convs = [16, 32, 32, 64, 64, 128, 128]
-    nb_downsamples = len(encoder_convs) - 1
-    N_train_batches = ret.nbr_train_batches
-    N_val_batches = ret.nbr_val_batches
-
-    lr_temp = str(ret.learning_rate)
-    br_temp = str(ret.brightness)
-
-    name = curr_date + "_" + curr_time + "_" + ret.network + "_bs_" + str(ret.batch_size) + "_as_" + \
-        str(ret.accum_steps) + "_lr_" + str(ret.learning_rate) + "_d_" + str(ret.dropout) + "_bl_" + str(ret.blur) + "_br_" + \
-        str(ret.brightness) + "_h_" + str(ret.hue) + "_s_" + str(ret.saturation) + "_st_" + str(ret.shift) + \
-        "_fl_" + str(ret.flip) + "_rt_" + str(ret.rot) + "_mp_" + \
-        str(ret.mixed_precision) + "_ntb_" + str(N_train_batches) + "_nvb_" + str(N_val_batches)
-
+# stages of the train input pipeline, create_datasets can stop after each of them (see benchmark_pipeline.py)
+PIPELINE_STAGES = ["sample", "read", "augment", "batch"]
+
+
+def create_pipeline_resources(ret, img_size=1024, batch_size=None):
+    """
+    Enable the patch caches and start the loader processes of the input pipeline, once for all pipelines created
+    with them by create_datasets (ex: the stages timed by benchmark_pipeline.py), which then share warm caches and
+    loader processes instead of starting new ones
+    :param ret: parsed arguments (see get_parser)
+    :param img_size: patch size
+    :param batch_size: largest (per replica) batch size of the pipelines, sets the number of loader slots.
+        ret.batch_size if None
+    :return: dict of the enabled patch caches ("caches", to log with PipelineStatsLogger) and the loader ("loader",
+        source.loader.SharedMemoryLoader, None if not used)
+    """
+    # keep decoded patches in RAM, patches are drawn with replacement and read many times during training
+    # and a cache shared with other runs on the same node, to read and store each patch once for all runs
+    caches = []
+    if (ret.cache_gb > 0 or ret.shm_cache) and ret.records:
+        print("Patch caches are not used with --records, TFRecords are decoded in the graph.")
+    elif ret.cache_gb > 0 or ret.shm_cache:
+        if ret.cache_gb > 0:
+            caches.append(enable_patch_cache(ret.cache_gb))
+            if ret.loader:
+                print("The in-memory patch cache is only used for val with --loader, use --shm_cache to share a "
+                      "cache with the loader processes.")
+        if ret.shm_cache:
+            caches.append(enable_shared_patch_cache(ret.shm_cache))
+
+    loader = None
+    if ret.loader and not ret.records:
+        # read train patches in worker processes into shared memory, instead of tf.py_function in this process
+        batch_size = batch_size or ret.batch_size
+        loader = SharedMemoryLoader(ret.loader, img_size, nb_slots=max(2 * ret.loader, 2 * batch_size),
+                                    min_tissue=ret.crop_min_tissue, shm_cache=ret.shm_cache)
+    return {"caches": caches, "loader": loader}
+
+
+def val_cache_prefix(ret, pipeline_id=0):
+    """
+    :return: file prefix of the fixed val cache of an input pipeline, "" to keep it in RAM. Caches of runs with other
+        val patches (seed, batch size, number of val batches, dataset, core crops) and of the other input pipelines
+        (ex: local workers of launch_workers.py) are kept apart. Without seed, the val patches are drawn anew by each
+        run, which gets its own cache files
+    """
+    if not ret.val_cache:
+        return ""
+    key = json.dumps([ret.seed, ret.batch_size, ret.nbr_val_batches, ret.nbr_classes, ret.records,
+                      ret.dataset_path, ret.dataset_path_wsi, ret.manifests, ret.crop_min_tissue])
+    prefix = ret.val_cache + "_" + hashlib.md5(key.encode("utf-8")).hexdigest()[:10] + "_pipeline_" + \
+        str(pipeline_id)
+    if not ret.seed:
+        return prefix + "_run_" + datetime.now().strftime("%Y%m%d_%H%M%S") + "_" + str(os.getpid())
+    if os.path.exists(prefix + ".index"):
+        print("Reusing the fixed val patches cached in " + prefix + " by an earlier run with the same arguments.")
+    return prefix
+
+
+def create_datasets(ret, img_size=1024, stage="batch", miner=None, context=None, crop_size=None, resources=None):
+    """
+    Create the train and val input pipelines from the command line arguments
+    :param ret: parsed arguments (see get_parser)
+    :param img_size: patch size
+    :param stage: stop the train pipeline after this stage, one of PIPELINE_STAGES. The val pipeline is only
+        complete for "batch"
+    :param miner: source.mining.HardPatchMiner to draw train patches by their loss, built here with the number of
+        train patches. Train elements then also carry the score table index of the patch, and the batches are
+        formatted for source.mining.add_hard_patch_mining. Not used if None
+    :param context: tf.distribute.InputContext of this input pipeline, when training with a distribution strategy
+        (see source.distribute). Batches are then per replica (ret.batch_size is the global batch size), train
+        patches are drawn with a seed of their own and the fixed val patches are split between the input pipelines
+    :param crop_size: train on random crops and validate on center crops of this size (ex: early phases of a
+        progressive resolution schedule). Full img_size patches if None
+    :param resources: patch caches and loader from create_pipeline_resources, created for this pipeline only if None
+    :return: train dataset, val dataset, class names and pipeline statistics to log (enabled patch caches and
+        source counter, see PipelineStatsLogger)
+    """
     #  paths
-    dataset_path = '/'
-    dataset_path_wsi = '/'
+    dataset_path = ret.dataset_path.rstrip("/") + "/"
+    dataset_path_wsi = ret.dataset_path_wsi.rstrip("/") + "/"
     train_path = dataset_path + 'ds_train'
     train_path_wsi = dataset_path_wsi + 'ds_train'
     val_path = dataset_path + 'ds_val'
     val_path_wsi = dataset_path_wsi + 'ds_val'
+    records_path = dataset_path + 'records/'  # created with convert_to_tfrecords.py
+    records_path_wsi = dataset_path_wsi + 'records/'
     # test_path = dataset_path + 'ds_test'
-    history_path = './output/history/'  # path to directory
-    model_path = './output/models/'  # path to directory
+
+    seed = ret.seed if ret.seed else None
+    batch_size = ret.batch_size
+    nb_pipelines, pipeline_id = 1, 0
+    if context is not None:
+        batch_size = context.get_per_replica_batch_size(ret.batch_size)
+        nb_pipelines, pipeline_id = context.num_input_pipelines, context.input_pipeline_id
+    # with the same seed, the input pipelines of all workers would draw the same train patches
+    train_seed = seed + pipeline_id if seed is not None else None
+    if ret.data_service:
+        if not ret.records:
+            raise ValueError("--data_service requires --records 1, the .h5 readers are Python functions that can not "
+                             "run on tf.data service workers.")
+        if seed is not None:
+            # the seeds are fixed in the graph serialized to the workers, every worker would produce the same batches
+            raise ValueError("--seed is not supported with --data_service, each worker must draw its own patches.")
+
+    # weight train patches by the statistics stored in the manifests (tissue fraction, class pixels)
+    weighted_sampling = ret.tissue_power != 0 or ret.min_tissue > 0 or ret.label_power != 0
+    if weighted_sampling and (ret.records or not ret.manifests):
+        raise ValueError("--tissue_power, --min_tissue and --label_power require --manifests, and are not supported "
+                         "with --records.")
+
+    if miner is not None and (ret.records or ret.loader):
+        raise ValueError("--mining is not supported with --records or --loader.")
+
+    # augmentations are seeded per element from (epoch, index), reproducible with any number of parallel calls
+    aug_seed = ret.seed + pipeline_id if ret.seed else np.random.randint(1, 2 ** 31 - 1)
+    samples_per_epoch = ret.nbr_train_batches * ret.batch_size // nb_pipelines
+    print("Augmentation seed:", aug_seed)
+    # fixed element order through the parallel maps, to replay exact batches
+    deterministic = bool(ret.deterministic)
+
+    if resources is None:
+        resources = create_pipeline_resources(ret, img_size, batch_size)
+    pipeline_stats = list(resources["caches"])
 
     # use this when only looking at all epithelium as one class
-    if ret.nbr_classes == 2:
+    if ret.nbr_classes == 2 and ret.records:
         class_names = ["epithelium"]
-        train_paths = []
-        for file_ in os.listdir(train_path + "/"):
-            file_path = train_path + "/" + file_
-            train_paths.append(file_path)  # nested list of three lists containing paths for each folder/class
-
-        val_paths = []
-        for file_ in os.listdir(val_path + "/"):
-            file_path = val_path + "/" + file_
-            val_paths.append(file_path)  # nested list of three lists containing paths for each folder/class
-
-        # combine all train/val paths
-        ds_train = tf.data.Dataset.from_generator(
-            get_random_path,  # get_random_path_from_random_class, for inv, ins, ben
-            output_shapes=tf.TensorShape([]),
-            output_types=tf.string,
-            args=[train_paths]  # val_paths for inv, ins, ben
-        )
+        ds_train = record_dataset(list_record_files(records_path + 'ds_train/'), img_size,
+                                  num_parallel_calls=ret.proc, seed=train_seed, deterministic=deterministic,
+                                  as_uint8=bool(ret.uint8))
+        ds_val = record_dataset(list_record_files(records_path + 'ds_val/'), img_size, num_parallel_calls=ret.proc,
+                                seed=seed, deterministic=deterministic, as_uint8=bool(ret.uint8))
 
-        ds_val = tf.data.Dataset.from_generator(
-            get_random_path,  # get_random_path_from_random_class, for inv, ins, ben
-            output_shapes=tf.TensorShape([]),
-            output_types=tf.string,
-            args=[val_paths]  # val_paths for inv, ins, ben @TODO: why brackets, does not make sense(?)
-        )
+    elif ret.nbr_classes == 2:
+        class_names = ["epithelium"]
+        if ret.manifests:
+            train_paths = sum(load_manifest(ret.manifests, "ds_train").values(), [])
+            val_paths = sum(load_manifest(ret.manifests, "ds_val").values(), [])
+        else:
+            train_paths = list_patch_paths(train_path + "/")
+            val_paths = list_patch_paths(val_path + "/")
+
+        # draw random train/val paths in the graph
+        train_weights = None
+        if weighted_sampling:
+            train_weights = sampling_weights(train_paths, load_patch_stats(ret.manifests, "ds_train"),
+                                             ret.tissue_power, ret.min_tissue, ret.label_power)
+        if miner is not None:
+            miner.build(len(train_paths))
+            ds_train = mined_path_dataset(train_paths, miner, train_weights, seed=train_seed)
+            pipeline_stats.append(miner)
+        elif weighted_sampling:
+            ds_train = weighted_path_dataset(train_paths, train_weights, seed=train_seed)
+        else:
+            ds_train = random_path_dataset(train_paths, seed=train_seed)
+        ds_val = random_path_dataset(val_paths, seed=seed)
 
     # use this with invasive, benign, insitu
-    if ret.nbr_classes == 4:
+    # each source (TMA and WSI, or sources/cohorts in the manifests) is drawn with its own weight
+    if ret.nbr_classes == 4 and ret.records:
         class_names = ["invasive", "benign", "insitu"]
-        train_paths = []
-        for directory in os.listdir(train_path):
-            dir_path = train_path + "/" + directory + "/"
-            dir_paths = []
-            for file_ in os.listdir(dir_path):
-                file_path = dir_path + file_
-                dir_paths.append(file_path)
-            train_paths.append(dir_paths)  # nested list of three lists containing paths for each folder/class
-        for i, directory in enumerate(os.listdir(train_path_wsi)):
-            dir_path = train_path_wsi + "/" + directory + "/"
-            for file_ in os.listdir(dir_path):
-                file_path = dir_path + file_
-                train_paths[i].append(file_path)  # nested list of three lists containing paths for each folder/class
-
-        val_paths = []
-        for directory in os.listdir(val_path):
-            dir_path = val_path + "/" + directory + "/"
-            dir_paths = []
-            for file_ in os.listdir(dir_path):
-                file_path = dir_path + file_
-                dir_paths.append(file_path)
-            val_paths.append(dir_paths)  # nested list of three lists containing paths for each folder/class
-        for i, directory in enumerate(os.listdir(val_path_wsi)):
-            dir_path = val_path_wsi + "/" + directory + "/"
-            for file_ in os.listdir(dir_path):
-                file_path = dir_path + file_
-                val_paths[i].append(file_path)  # nested list of three lists containing paths for each folder/class
-
-        # combine all train/val paths
-        ds_train = tf.data.Dataset.from_generator(
-            get_random_path_from_random_class,
-            output_shapes=tf.TensorShape([]),
-            output_types=tf.string,
-            args=train_paths
-        )
-
-        ds_val = tf.data.Dataset.from_generator(
-            get_random_path_from_random_class,
-            output_shapes=tf.TensorShape([]),
-            output_types=tf.string,
-            args=val_paths
-        )
+        train_sources = {"tma": records_path + 'ds_train/', "wsi": records_path_wsi + 'ds_train/'}
+        source_names = list(train_sources)
+        # variables can not be sent to tf.data service workers, sources are not counted there
+        source_counter = SourceCounter(source_names) if not ret.data_service else None
+        # by default, sources are drawn in proportion to their number of TFRecord files
+        source_weights = ret.source_weights or [len(list_class_record_files(train_sources[name]))
+                                                for name in source_names]
+        print("Train sources:", dict(zip(source_names, source_weights)))
+        ds_train = mix_sources([class_balanced_record_dataset([train_sources[name]], img_size,
+                                                              weights=ret.class_weights, seed=train_seed,
+                                                              num_parallel_calls=ret.proc, deterministic=deterministic,
+                                                              as_uint8=bool(ret.uint8))
+                                for name in source_names], source_weights, seed=train_seed, counter=source_counter)
+        if source_counter is not None:
+            pipeline_stats.append(source_counter)
+        ds_val = class_balanced_record_dataset([records_path + 'ds_val/', records_path_wsi + 'ds_val/'],
+                                               img_size, seed=seed, num_parallel_calls=ret.proc,
+                                               deterministic=deterministic, as_uint8=bool(ret.uint8))
+
+    elif ret.nbr_classes == 4:
+        class_names = ["invasive", "benign", "insitu"]
+        if ret.manifests:
+            # paths for each class of each source, loaded from TMA and WSI manifests
+            train_sources = load_manifest_sources(ret.manifests, "ds_train", ret.source_key)
+            val_sources = load_manifest_sources(ret.manifests, "ds_val", ret.source_key)
+        else:
+            train_sources = {"tma": list_class_paths(train_path + "/"), "wsi": list_class_paths(train_path_wsi + "/")}
+            val_sources = {"tma": list_class_paths(val_path + "/"), "wsi": list_class_paths(val_path_wsi + "/")}
+
+        # class folders are matched by name across sources, nested list of paths for each class of each source
+        class_dirs = sorted(set(x for classes in list(train_sources.values()) + list(val_sources.values())
+                                for x in classes))
+        train_paths = {name: [classes.get(x, []) for x in class_dirs] for name, classes in train_sources.items()
+                       if sum(len(paths) for paths in classes.values()) > 0}
+        val_paths = [sum((classes.get(x, []) for classes in val_sources.values()), []) for x in class_dirs]
+        source_names = list(train_paths)
+        source_counter = SourceCounter(source_names)
+        # by default, sources are drawn in proportion to their number of patches
+        source_weights = ret.source_weights or [sum(len(paths) for paths in train_paths[name])
+                                                for name in source_names]
+        print("Train sources:", dict(zip(source_names, source_weights)))
+
+        # draw random source, random class (with class weights for train) and random path of that class in the graph
+        train_stats = load_patch_stats(ret.manifests, "ds_train") if weighted_sampling else None
+        if miner is not None:
+            miner.build(sum(len(paths) for name in source_names for paths in train_paths[name]))
+            pipeline_stats.append(miner)
+        datasets = []
+        for name in source_names:
+            train_weights = None
+            if weighted_sampling:
+                train_weights = [sampling_weights(paths, train_stats, ret.tissue_power, ret.min_tissue,
+                                                  ret.label_power) for paths in train_paths[name]]
+            datasets.append(class_balanced_path_dataset(train_paths[name], weights=ret.class_weights, seed=train_seed,
+                                                        patch_weights=train_weights, miner=miner))
+        ds_train = mix_sources(datasets, source_weights, seed=train_seed, counter=source_counter)
+        pipeline_stats.append(source_counter)
+        ds_val = class_balanced_path_dataset(val_paths, seed=seed)
+
+    if stage == "sample":
+        return ds_train, ds_val, class_names, pipeline_stats
+
+    # with --uint8, images stay uint8 through the pipeline (4x less memory) and are rescaled in the model
+    image_dtype = tf.uint8 if ret.uint8 else tf.float32
+
+    # sampled train paths, read by the loader processes with --loader
+    ds_train_paths = ds_train
+
+    if not ret.records:
+        # stored TMA cores are cropped by the readers with a seed drawn from the element seed, for the same crops
+        # whichever thread reads the patch
+        def add_crop_seed(i, x, salt):
+            x = x if isinstance(x, tuple) else (x,)
+            crop_seed = tf.random.stateless_uniform([], seed=fold_seed(element_seed(aug_seed, i, samples_per_epoch),
+                                                                       salt), minval=0, maxval=2 ** 62, dtype=tf.int64)
+            return (x[0], crop_seed, *x[1:])
+
+        ds_train = ds_train.enumerate().map(lambda i, x: add_crop_seed(i, x, 9))
+        ds_val = ds_val.enumerate().map(lambda i, x: add_crop_seed(i, x, 10))
 
     # load patch from randomly selected patch
-    ds_train = ds_train.map(lambda x: tf.py_function(patchReader, [x], [tf.float32, tf.float32]),
-                            num_parallel_calls=ret.proc, deterministic=False)
-    ds_val = ds_val.map(lambda x: tf.py_function(patchReader, [x], [tf.float32, tf.float32]),
-                        num_parallel_calls=ret.proc, deterministic=False)
+    if ret.records:
+        # TFRecords are already decoded in the graph, gt is stored as label map
+        ds_train = ds_train.map(lambda x, y: one_hot_labelmap(x, y, ret.nbr_classes))
+        ds_val = ds_val.map(lambda x, y: one_hot_labelmap(x, y, ret.nbr_classes))
+    elif ret.labelmap:
+        # read gt as uint8 label map, one-hot encoding is done in the graph
+        def read(path, seed):
+            return labelmapReader(path, as_uint8=ret.uint8, crop_size=img_size, min_tissue=ret.crop_min_tissue,
+                                  seed=seed)
+
+        ds_train = ds_train.map(lambda x, s, *p: (*tf.py_function(read, [x, s], [image_dtype, tf.uint8]), *p),
+                                num_parallel_calls=ret.proc, deterministic=deterministic)
+        ds_val = ds_val.map(lambda x, s: tf.py_function(read, [x, s], [image_dtype, tf.uint8]),
+                            num_parallel_calls=ret.proc, deterministic=deterministic)
+        ds_train = ds_train.map(lambda x, y, *p: (*one_hot_labelmap(x, y, ret.nbr_classes), *p))
+        ds_val = ds_val.map(lambda x, y: one_hot_labelmap(x, y, ret.nbr_classes))
+    else:
+        # stored TMA cores are randomly cropped to img_size by the readers
+        def read(path, seed):
+            return patchReader(path, nb_classes=ret.nbr_classes, as_uint8=ret.uint8, crop_size=img_size,
+                               min_tissue=ret.crop_min_tissue, seed=seed)
+
+        ds_train = ds_train.map(lambda x, s, *p: (*tf.py_function(read, [x, s], [image_dtype, tf.float32]), *p),
+                                num_parallel_calls=ret.proc, deterministic=deterministic)
+        ds_val = ds_val.map(lambda x, s: tf.py_function(read, [x, s], [image_dtype, tf.float32]),
+                            num_parallel_calls=ret.proc, deterministic=deterministic)
+
+    if resources["loader"] is not None:
+        # read train patches in worker processes into shared memory, instead of tf.py_function in this process
+        ds_train = resources["loader"].dataset(ds_train_paths)
+        ds_train = ds_train.map(lambda x, y: one_hot_labelmap(tf.cast(x, image_dtype), y, ret.nbr_classes))
+
+    # outputs of tf.py_function have no static shape, which the augmentations need (ex: blur)
+    # with --mining, train elements also carry the score table index of the patch (p)
+    ds_train = ds_train.map(lambda x, y, *p: (tf.ensure_shape(x, [img_size, img_size, 3]),
+                                              tf.ensure_shape(y, [img_size, img_size, None]), *p))
+    ds_val = ds_val.map(lambda x, y: (tf.ensure_shape(x, [img_size, img_size, 3]),
+                                      tf.ensure_shape(y, [img_size, img_size, None])))
+
+    if ret.fixed_val:
+        # fixed val subset, drawn and read once, then served from a cache every epoch (stable val loss for early
+        # stopping, no val I/O after the first epoch). Stored as uint8 image and label map (4 MB per 1024 patch)
+        # with a distribution strategy, each input pipeline gets its share of the fixed val patches (the same
+        # patches for all pipelines with --seed)
+        ds_val = ds_val.take(ret.nbr_val_batches * ret.batch_size).shard(nb_pipelines, pipeline_id)
+        ds_val = ds_val.map(lambda x, y: (tf.cast(x, tf.uint8), tf.cast(tf.argmax(y, axis=-1), tf.uint8)))
+        ds_val = ds_val.cache(val_cache_prefix(ret, pipeline_id)).repeat()
+        ds_val = ds_val.map(lambda x, y: one_hot_labelmap(tf.cast(x, image_dtype), y, ret.nbr_classes))
 
     # @TODO: Check if good idea to do deterministic=False here as well (as in lines above)
     # normalize intensities
-    ds_train = ds_train.map(normalize_img)  # , num_parallel_calls=tf.data.AUTOTUNE)
-    ds_val = ds_val.map(normalize_img)  # , num_parallel_calls=tf.data.AUTOTUNE)
+    if not ret.uint8:
+        ds_train = ds_train.map(lambda x, y, *p: (*normalize_img(x, y), *p))  # , num_parallel_calls=tf.data.AUTOTUNE)
+        ds_val = ds_val.map(normalize_img)  # , num_parallel_calls=tf.data.AUTOTUNE)
 
     # batch data before aug -> faster, can't do with agunet
     # ds_train = ds_train.batch(ret.batch_size)
     # ds_val = ds_val.batch(ret.batch_size)
 
-    # only augment train data
-    # shift last
-    if ret.brightness:
-        ds_train = ds_train.map(lambda x, y: (random_brightness(x, brightness=ret.brightness), y), num_parallel_calls=1)  # ADDITIVE
-    if ret.hue:
-        ds_train = ds_train.map(lambda x, y: (random_hue(x, max_delta=ret.hue), y), num_parallel_calls=1)  # ADDITIVE
-    if ret.saturation:
-        ds_train = ds_train.map(lambda x, y: (random_saturation(x, saturation=ret.saturation), y),
-                            num_parallel_calls=1)  # @TODO: MULTIPLICATIVE?
-    if ret.blur:
-        ds_train = ds_train.map(lambda x, y: (random_blur(x), y), num_parallel_calls=1)
-    if ret.rot:
-        ds_train = ds_train.map(lambda x, y: (random_rot90(x, y)), num_parallel_calls=1)
-    if ret.flip:
-        ds_train = ds_train.map(lambda x, y: (random_flipud(x, y)), num_parallel_calls=1)
-        ds_train = ds_train.map(lambda x, y: (random_fliplr(x, y)), num_parallel_calls=1)
-    if ret.shift:
-        ds_train = ds_train.map(lambda x, y: random_shift(x, y, translate=50), num_parallel_calls=1)
-
-    # create multiscale input
-    # tf.py_function(patchReader, [x], [tf.float32, tf.float32])
-    if ret.network == "agunet":
-        ds_train = ds_train.map(lambda x, y: (x, create_multiscale_input(y, nb_downsamples)), num_parallel_calls=1)
-        ds_val = ds_val.map(lambda x, y: (x, create_multiscale_input(y, nb_downsamples)), num_parallel_calls=1)
-
-    # batch data before aug -> faster
-    ds_train = ds_train.batch(ret.batch_size)
-    ds_val = ds_val.batch(ret.batch_size)
+    if stage == "read":
+        return ds_train, ds_val, class_names, pipeline_stats
+
+    # index each train element, to seed its augmentations
+    ds_train = ds_train.enumerate()
+    if ret.data_service:
+        # tf.data service workers run the same graph (and aug_seed), elements are indexed by a random number drawn by
+        # each worker instead, for the workers to augment differently
+        ds_train = tf.data.Dataset.zip((tf.data.Dataset.random(), ds_train)).map(lambda r, ixy: (r, ixy[1]))
+
+    if crop_size is not None and crop_size < img_size:
+        # random crops, seeded per element as the augmentations
+        ds_train = ds_train.map(lambda i, xy: (i, (*random_crop(xy[0], xy[1], crop_size, seed=fold_seed(
+            element_seed(aug_seed, i, samples_per_epoch), 8)), *xy[2:])), num_parallel_calls=ret.proc,
+            deterministic=deterministic)
+
+    if ret.batch_aug:
+        # batch first, then augment the whole batch as one vectorized stage, with random parameters drawn per sample
+        ds_train = ds_train.batch(batch_size, drop_remainder=True)  # static batch size, dataset is infinite
+        ds_train = ds_train.map(lambda i, xy: (*batch_augment(
+            xy[0], xy[1], brightness=ret.brightness, hue=ret.hue, saturation=ret.saturation, blur=ret.blur,
+            rot=ret.rot, flip=ret.flip, shift=ret.shift, translate=50,
+            seed=element_seed(aug_seed, i[0], samples_per_epoch)),
+            *xy[2:]), num_parallel_calls=ret.proc, deterministic=deterministic)
+        if stage == "augment":
+            return ds_train, ds_val, class_names, pipeline_stats
+    else:
+        ds_train = ds_train.map(lambda i, xy: (xy[0], xy[1], element_seed(aug_seed, i, samples_per_epoch), *xy[2:]))
+
+        # only augment train data, each augmentation with its own seed derived from the element seed
+        # shift last
+        if ret.brightness:
+            ds_train = ds_train.map(lambda x, y, s, *p: (random_brightness(x, brightness=ret.brightness, seed=fold_seed(s, 0)), y, s, *p),
+                                    num_parallel_calls=ret.proc, deterministic=deterministic)  # ADDITIVE
+        if ret.hue:
+            ds_train = ds_train.map(lambda x, y, s, *p: (random_hue(x, max_delta=ret.hue, seed=fold_seed(s, 1)), y, s, *p),
+                                    num_parallel_calls=ret.proc, deterministic=deterministic)  # ADDITIVE
+        if ret.saturation:
+            ds_train = ds_train.map(lambda x, y, s, *p: (random_saturation(x, saturation=ret.saturation, seed=fold_seed(s, 2)), y, s, *p),
+                                    num_parallel_calls=ret.proc, deterministic=deterministic)  # @TODO: MULTIPLICATIVE?
+        if ret.blur:
+            ds_train = ds_train.map(lambda x, y, s, *p: (random_blur(x, seed=fold_seed(s, 3)), y, s, *p),
+                                    num_parallel_calls=ret.proc, deterministic=deterministic)
+        if ret.rot:
+            ds_train = ds_train.map(lambda x, y, s, *p: (*random_rot90(x, y, seed=fold_seed(s, 4)), s, *p),
+                                    num_parallel_calls=ret.proc, deterministic=deterministic)
+        if ret.flip:
+            ds_train = ds_train.map(lambda x, y, s, *p: (*random_flipud(x, y, seed=fold_seed(s, 5)), s, *p),
+                                    num_parallel_calls=ret.proc, deterministic=deterministic)
+            ds_train = ds_train.map(lambda x, y, s, *p: (*random_fliplr(x, y, seed=fold_seed(s, 6)), s, *p),
+                                    num_parallel_calls=ret.proc, deterministic=deterministic)
+        if ret.shift:
+            ds_train = ds_train.map(lambda x, y, s, *p: (*random_shift(x, y, translate=50, seed=fold_seed(s, 7)), s, *p),
+                                    num_parallel_calls=ret.proc, deterministic=deterministic)
+
+        if stage == "augment":
+            return ds_train.map(lambda x, y, s, *p: (x, y, *p)), ds_val, class_names, pipeline_stats
+
+        # only the full resolution gt is batched, the losses downsample it for the AGU-Net deep supervision outputs
+        # tf.py_function(patchReader, [x], [tf.float32, tf.float32])
+        ds_train = ds_train.map(lambda x, y, s, *p: (x, y, *p))
+
+        # batch data before aug -> faster
+        ds_train = ds_train.batch(batch_size)
+
+    if miner is not None:
+        # inputs of the model wrapped by add_hard_patch_mining: image, gt and score table index (-1 for val, not
+        # recorded)
+        def mining_inputs(x, y, p):
+            return (x, y, p), y
+
+        ds_train = ds_train.map(mining_inputs)
+
+    if ret.data_service:
+        # reading, augmentation and batching of train data run on the tf.data service workers, each worker produces
+        # its own stream of batches
+        ds_train = ds_train.apply(tf.data.experimental.service.distribute(
+            processing_mode=tf.data.experimental.service.ShardingPolicy.OFF, service=ret.data_service))
+
+    if crop_size is not None and crop_size < img_size:
+        ds_val = ds_val.map(lambda x, y: center_crop(x, y, crop_size))
+    ds_val = ds_val.batch(batch_size)
+    if miner is not None:
+        ds_val = ds_val.map(lambda x, y: mining_inputs(x, y, tf.fill(tf.shape(x)[:1], tf.constant(-1, tf.int64))))
 
     # prefetch augmented batches -> GPU does not need to wait -> batch always ready
     ds_train = ds_train.prefetch(1)
     ds_val = ds_val.prefetch(1)
 
+    return ds_train, ds_val, class_names, pipeline_stats
+
+
+def create_model(ret, img_size=1024, encoder_convs=(16, 32, 32, 64, 64, 128, 128)):
+    """
+    Create network from the command line arguments, taking float input in [0, 1]
+    :param ret: parsed arguments (see get_parser)
+    :param img_size: patch size
+    :param encoder_convs: number of filters in each encoder level
+    :return: keras model
+    """
+    encoder_convs = list(encoder_convs)
+    if ret.checkpointing and ret.network != "agunet":
+        raise ValueError("--checkpointing is only supported with --network agunet.")
+    if ret.xla and ret.network != "agunet":
+        # the gradient of UpSampling2D (ResizeNearestNeighborGrad) in the unet has no XLA kernel
+        raise ValueError("--xla is only supported with --network agunet.")
     if ret.network == "unet":
         convs = encoder_convs + encoder_convs[:-1][::-1]
         network = Unet(input_shape=(img_size, img_size, 3), nb_classes=ret.nbr_classes)  # binary = 2
         network.set_convolutions(convs)
         model = network.create()
     elif ret.network == "agunet":
-        agunet = AttentionUnet(input_shape=(1024, 1024, 3), nb_classes=ret.nbr_classes,
+        agunet = AttentionUnet(input_shape=(img_size, img_size, 3), nb_classes=ret.nbr_classes,
                                encoder_spatial_dropout=ret.dropout, decoder_spatial_dropout=None,
                                accum_steps=ret.accum_steps, deep_supervision=True, input_pyramid=True, grad_accum=False,
-                               encoder_use_bn=True, decoder_use_bn=True)
+                               encoder_use_bn=True, decoder_use_bn=True, xla=bool(ret.xla),
+                               checkpointing=bool(ret.checkpointing))
         agunet.set_convolutions(encoder_convs)
         model = agunet.create()
 
     else:
         raise ValueError("Unsupported architecture chosen. Please, choose either 'unet' or 'agunet'.")
 
-    if ret.accum_steps > 1:
-        model = GradientAccumulateModel(
-            accum_steps=ret.accum_steps, mixed_precision=ret.mixed_precision, inputs=model.input, outputs=model.outputs
-        )
+    return model
+
+
+def precision_policy(ret):
+    """
+    :return: keras mixed precision policy from the command line arguments (--precision, or --mixed_precision)
+    """
+    return "mixed_float16" if ret.mixed_precision else ret.precision
+
+
+def parse_schedule(schedule, img_size=1024, nb_levels=7, epochs=500):
+    """
+    :param schedule: phases of the progressive resolution schedule, as "size:batch_size:epochs", trained before the
+        full resolution epochs
+    :param img_size: full patch size
+    :param nb_levels: number of encoder levels of the network (len(encoder_convs))
+    :param epochs: total number of epochs, including the phases
+    :return: list of (patch size, batch size, epochs) of each phase
+    """
+    phases = []
+    for phase in schedule:
+        size, batch_size, phase_epochs = (int(x) for x in phase.split(":"))
+        # the AGU-Net downsamples nb_levels - 1 times, down to more than 4 pixels before the last level
+        if size >= img_size or size % 2 ** (nb_levels - 1) != 0 or size // 2 ** (nb_levels - 2) <= 4:
+            raise ValueError("Schedule patch sizes must be multiples of " + str(2 ** (nb_levels - 1)) +
+                             ", larger than " + str(4 * 2 ** (nb_levels - 2)) + " and smaller than " + str(img_size) +
+                             ": " + phase)
+        phases.append((size, batch_size, phase_epochs))
+    if sum(x[2] for x in phases) >= epochs:
+        raise ValueError("The schedule phases must leave full resolution epochs, increase --epochs.")
+    return phases
+
+
+def compile_model(ret, model, class_names):
+    """
+    Compile the model with the optimizer, dice loss and class dice metrics from the command line arguments
+    :param ret: parsed arguments (see get_parser)
+    :param model: keras model
+    :param class_names: names of the classes without background, for the metrics
+    """
+    # bfloat16 has the range of float32, no loss scaling needed
+    if precision_policy(ret) == "mixed_float16":
+        opt = tf.keras.optimizers.Adam(ret.learning_rate, epsilon=1e-4)  # , was epsilon=1e-4) before 30.05.23
+        opt = mixed_precision.LossScaleOptimizer(opt)
+    else:
+        opt = tf.keras.optimizers.Adam(ret.learning_rate, epsilon=1e-7)
+
+    # with a distribution strategy, the dice loss is computed on the batch of each replica and averaged
+    # with --xla, the whole train step is compiled with XLA, fusing the many small ops (1x1 convolutions, BN,
+    # concatenations) of the attention and decoder blocks
+    model.compile(
+        optimizer=opt,
+        loss=get_dice_loss(nb_classes=ret.nbr_classes, use_background=False, dims=2),
+        # loss_weights=None if architecture == "unet" else loss_weights,
+        metrics=[
+            *[class_dice_loss(class_val=i + 1, metric_name=x) for i, x in enumerate(class_names)]
+        ],
+        run_eagerly=False,
+        jit_compile=bool(ret.xla),
+    )
+
+
+def main(ret):
+    curr_date = "".join(date.today().strftime("%d/%m").split("/")) + date.today().strftime("%Y")[2:]
+    curr_time = "".join(str(datetime.now()).split(" ")[1].split(".")[0].split(":"))
+
+    img_size = 1024
+
+    # network stuff
+    encoder_convs = [16, 32, 32, 64, 64, 128, 128]
+    N_train_batches = ret.nbr_train_batches
+    N_val_batches = ret.nbr_val_batches
+
+    lr_temp = str(ret.learning_rate)
+    br_temp = str(ret.brightness)
+
+    name = curr_date + "_" + curr_time + "_" + ret.network + "_bs_" + str(ret.batch_size) + "_as_" + \
+        str(ret.accum_steps) + "_lr_" + str(ret.learning_rate) + "_d_" + str(ret.dropout) + "_bl_" + str(ret.blur) + "_br_" + \
+        str(ret.brightness) + "_h_" + str(ret.hue) + "_s_" + str(ret.saturation) + "_st_" + str(ret.shift) + \
+        "_fl_" + str(ret.flip) + "_rt_" + str(ret.rot) + "_mp_" + \
+        (str(ret.mixed_precision) if ret.precision == "float32" else ret.precision) + "_ntb_" + str(N_train_batches) + \
+        "_nvb_" + str(N_val_batches)
+
+    #  paths
+    history_path = './output/history/'  # path to directory
+    model_path = './output/models/'  # path to directory
+
+    # progressive resolution schedule, phases trained on smaller patches before the full resolution epochs
+    phases = parse_schedule(ret.schedule, img_size, len(encoder_convs), ret.epochs)
+
+    # data-parallel training over several devices/workers, each process runs its own input pipeline
+    strategy = create_strategy(ret.strategy, ret.cpu_replicas)
+    context = input_context(strategy) if strategy is not None else None
+    if strategy is not None:
+        print("Number of replicas:", strategy.num_replicas_in_sync)
+
+    # draw hard (high loss) train patches more often
+    miner = HardPatchMiner(ret.mining_decay, ret.mining_max_ratio) if ret.mining else None
+
+    # patch caches and loader processes shared by the pipelines of all phases, with slots for the largest batches
+    batch_sizes = [ret.batch_size] + [batch_size for _, batch_size, _ in phases]
+    if context is not None:
+        batch_sizes = [context.get_per_replica_batch_size(x) for x in batch_sizes]
+    resources = create_pipeline_resources(ret, img_size, max(batch_sizes))
+
+    def datasets(args, crop_size=None):
+        ds_train, ds_val, class_names, pipeline_stats = create_datasets(args, img_size, miner=miner, context=context,
+                                                                        crop_size=crop_size, resources=resources)
+        if strategy is not None:
+            ds_train = distribute_dataset(strategy, ds_train)
+            ds_val = distribute_dataset(strategy, ds_val)
+        return ds_train, ds_val, class_names, pipeline_stats
+
+    def build_model(size):
+        """
+        :return: model to train and the float model inside it (without rescaling, mining and gradient accumulation)
+        """
+        model = float_model = create_model(ret, size, encoder_convs)
+        if ret.uint8:
+            # input images in [0, 255] are rescaled in the model
+            model = add_rescaling(float_model, 1 / 255.)
+        if miner is not None:
+            # record the loss of each train patch in the score table of the miner
+            model = add_hard_patch_mining(model, miner, ret.nbr_classes)
+
+        if ret.accum_steps > 1:
+            model = GradientAccumulateModel(
+                accum_steps=ret.accum_steps, mixed_precision=precision_policy(ret) == "mixed_float16",
+                inputs=model.input, outputs=model.outputs
+            )
+        return model, float_model
+
+    ds_train, ds_val, class_names, pipeline_stats = datasets(ret)
+
+    with strategy_scope(strategy):
+        # the full resolution model is built before the models of the schedule phases, to keep the layer (and loss)
+        # names monitored below
+        model, float_model = build_model(img_size)
+
+        export_model = float_model
+        if precision_policy(ret) == "mixed_bfloat16":
+            # the saved model computes in float32 as before (ONNX/FastPathology), the weights are copied to a float32
+            # copy of the model to save it
+            mixed_precision.set_global_policy("float32")
+            export_model = create_model(ret, img_size, encoder_convs)
+            mixed_precision.set_global_policy(precision_policy(ret))
 
     print(model.summary())
 
+    # the checkpoints and tensorboard logs of the other workers are written to temporary directories by keras, but
+    # each worker writes its own history
+    history_name = name if context is None or context.input_pipeline_id == 0 else \
+        name + "_worker_" + str(context.input_pipeline_id)
     history = CSVLogger(
-        history_path + "history_" + name + ".csv",
+        history_path + "history_" + history_name + ".csv",
         append=True
     )
 
@@ -227,37 +640,72 @@ def main(ret):
         mode="min",  # use "auto" with "f1_score", "auto" with "val_loss" (or "min")
         save_freq="epoch"
     )
+    if ret.uint8 or miner is not None or export_model is not float_model:
+        # save the float model inside the rescaling (and mining) instead, which takes the same input as before (float
+        # in [0, 1]), as expected by the ONNX conversion and the FastPathology pipelines (scale-factor 0.00392156862)
+        save_best = ExportModelCheckpoint(
+            export_model, model_path + "model_" + name, monitor="val_conv2d_54_loss", verbose=2, save_best_only=True,
+            save_weights_only=False, mode="min", save_freq="epoch",
+            weights_model=float_model if export_model is not float_model else None
+        )
 
+    # schedule phases, each with its own model (input size), pipelines and history, the weights are carried over to
+    # the next phase. Models are only saved, and early stopping and learning rate reduction only monitor, the full
+    # resolution epochs
+    initial_epoch = 0
+    for i, (size, batch_size, epochs) in enumerate(phases):
+        print("Phase " + str(i) + ": " + str(size) + "x" + str(size) + " patches, batch size " + str(batch_size) +
+              ", " + str(epochs) + " epochs")
+        phase_ret = Namespace(**vars(ret))
+        phase_ret.batch_size = batch_size
+        if ret.seed:
+            # with the same seed, each phase would draw (and augment) the same patches as the previous ones
+            phase_ret.seed = ret.seed * (len(phases) + 1) + i + 1
+        if ret.val_cache:
+            # the fixed val subset of each phase has its own number of patches
+            phase_ret.val_cache = ret.val_cache + "_phase_" + str(i)
+        ds_train_phase, ds_val_phase, _, phase_stats = datasets(phase_ret, crop_size=size)
+
+        with strategy_scope(strategy):
+            phase_model, phase_float_model = build_model(size)
+            phase_float_model.set_weights(float_model.get_weights())
+            compile_model(ret, phase_model, class_names)
+
+        phase_model.fit(
+            ds_train_phase,
+            steps_per_epoch=N_train_batches,
+            initial_epoch=initial_epoch,
+            epochs=initial_epoch + epochs,
+            validation_data=ds_val_phase,
+            validation_steps=N_val_batches,
+            callbacks=([PipelineStatsLogger(*phase_stats)] if phase_stats else []) +
+                      [CSVLogger(history_path + "history_" + history_name + "_phase_" + str(i) + ".csv", append=True),
+                       tb_logger],
+            verbose=1,
+        )
+        float_model.set_weights(phase_float_model.get_weights())
+        initial_epoch += epochs
 
-    if ret.mixed_precision:
-        opt = tf.keras.optimizers.Adam(ret.learning_rate, epsilon=1e-4)  # , was epsilon=1e-4) before 30.05.23
-        opt = mixed_precision.LossScaleOptimizer(opt)
-    else:
-        opt = tf.keras.optimizers.Adam(ret.learning_rate, epsilon=1e-7)
-
-    model.compile(
-        optimizer=opt,
-        loss=get_dice_loss(nb_classes=ret.nbr_classes, use_background=False, dims=2),
-        # loss_weights=None if architecture == "unet" else loss_weights,
-        metrics=[
-            *[class_dice_loss(class_val=i + 1, metric_name=x) for i, x in enumerate(class_names)]
-        ],
-        run_eagerly=False,
-    )
+    with strategy_scope(strategy):
+        compile_model(ret, model, class_names)
 
     model.fit(
         ds_train,
         steps_per_epoch=N_train_batches,
+        initial_epoch=initial_epoch,
         epochs=ret.epochs,
         validation_data=ds_val,
         validation_steps=N_val_batches,
-        callbacks=[save_best, history, early, tb_logger, reduce_lr],
+        callbacks=([PipelineStatsLogger(*pipeline_stats)] if pipeline_stats else []) +
+                  [save_best, history, early, tb_logger, reduce_lr],
         verbose=1,
     )
 
+    if resources["loader"] is not None:
+        resources["loader"].close()
 
-if __name__ == "__main__":
 
+def get_parser():
     parser = ArgumentParser()
     parser.add_argument('--batch_size', metavar='--bs', type=int, nargs='?', default=16,
                         help="set which batch size to use for training.")
@@ -265,6 +713,11 @@ if __name__ == "__main__":
                         help="set how many gradient accumulations to perform.")
     parser.add_argument('--mixed_precision', metavar='--mp', type=int, nargs='?', default=0,
                         help="whether to perform mixed precision (float16). Default=1 (True).")
+    parser.add_argument('--precision', metavar='--prec', type=str, nargs='?', default="float32",
+                        choices=["float32", "mixed_float16", "mixed_bfloat16"],
+                        help="mixed precision policy. mixed_bfloat16 for CPUs with bfloat16 support (AMX/AVX512-BF16), "
+                             "the saved model still computes in float32. --mixed_precision 1 is the same as "
+                             "mixed_float16.")
     parser.add_argument('--learning_rate', metavar='--lr', type=float, nargs='?', default=0.0005,
                         help="set which learning rate to use for training.")
     parser.add_argument('--epochs', metavar='--ep', type=int, nargs='?', default=500,
@@ -301,7 +754,100 @@ if __name__ == "__main__":
                         help="number of val batches.")
     parser.add_argument('--seed', metavar='--se', type=int, nargs='?', default=0,
                         help="perform seed or not.")
-    ret = parser.parse_known_args(sys.argv[1:])[0]
+    parser.add_argument('--dataset_path', metavar='--dp', type=str, nargs='?', default="/",
+                        help="path to TMA dataset, containing ds_train/, ds_val/ and records/.")
+    parser.add_argument('--dataset_path_wsi', metavar='--dpw', type=str, nargs='?', default="/",
+                        help="path to WSI dataset, containing ds_train/, ds_val/ and records/.")
+    parser.add_argument('--labelmap', metavar='--lm', type=int, nargs='?', default=0,
+                        help="read gt as uint8 label maps and one-hot encode in the tf.data graph. Works with "
+                             "datasets stored both as label maps and as one-hot.")
+    parser.add_argument('--records', metavar='--rec', type=int, nargs='?', default=0,
+                        help="read patches from TFRecords (see convert_to_tfrecords.py), decoded natively in tf.data.")
+    parser.add_argument('--manifests', metavar='--man', type=str, nargs='*', default=[],
+                        help="patch manifests (manifest.sqlite of TMA and/or WSI datasets) to load patch paths from, "
+                             "instead of listing the dataset folders.")
+    parser.add_argument('--cache_gb', metavar='--cgb', type=float, nargs='?', default=0,
+                        help="RAM budget (GB) of in-memory LRU cache of read patches, shared by train and val. "
+                             "0 disables the cache.")
+    parser.add_argument('--shm_cache', metavar='--shm', type=str, nargs='?', default=None,
+                        help="RAM-backed directory for patch cache shared by all runs on the node, "
+                             "ex: /dev/shm/epithelium_cache/. Remove it when done.")
+    parser.add_argument('--batch_aug', metavar='--ba', type=int, nargs='?', default=0,
+                        help="augment batches instead of single patches (same augmentations, one vectorized stage).")
+    parser.add_argument('--deterministic', metavar='--det', type=int, nargs='?', default=0,
+                        help="keep element order fixed through the parallel maps, so batches can be replayed "
+                             "exactly with the same --seed. Augmentations are seeded per element either way.")
+    parser.add_argument('--data_service', metavar='--dsv', type=str, nargs='?', default=None,
+                        help="address of tf.data service dispatcher (ex: grpc://node01:5050, see data_service.py) to "
+                             "run the train input pipeline on. Requires --records 1, not supported with --seed.")
+    parser.add_argument('--loader', metavar='--ld', type=int, nargs='?', default=0,
+                        help="number of worker processes reading train patches into shared memory, instead of "
+                             "tf.py_function in the trainer process. 0 disables the loader. Not used with --records.")
+    parser.add_argument('--uint8', metavar='--u8', type=int, nargs='?', default=0,
+                        help="keep images uint8 through the input pipeline and rescale them in the model. The saved "
+                             "model still takes float input in [0, 1].")
+    parser.add_argument('--class_weights', metavar='--cw', type=float, nargs='*', default=None,
+                        help="sampling weight of each class folder in the train set, in sorted folder order "
+                             "(benign, inSitu, invasive). Uniform if not set.")
+    parser.add_argument('--crop_min_tissue', metavar='--cmt', type=float, nargs='?', default=0.25,
+                        help="minimum tissue fraction of the patches cropped from stored TMA cores (.core.h5, see "
+                             "create_data_tma.py), as skip_percentage when storing patches.")
+    parser.add_argument('--fixed_val', metavar='--fv', type=int, nargs='?', default=1,
+                        help="validate on the same nbr_val_batches * batch_size patches every epoch, read once and "
+                             "cached. 0 draws new random val patches every epoch.")
+    parser.add_argument('--val_cache', metavar='--vc', type=str, nargs='?', default="",
+                        help="file prefix to cache the fixed val patches on disk, ex: /tmp/val_cache. Kept in RAM if "
+                             "not set. The seed, batch size, number of val batches, dataset, core crop tissue "
+                             "fraction and input pipeline are added to the prefix, runs with other val patches use "
+                             "other cache files. Only reused with --seed, runs without seed get their own cache "
+                             "files.")
+    parser.add_argument('--source_weights', metavar='--sw', type=float, nargs='*', default=None,
+                        help="sampling weight of each train source (4 classes), in sorted source order: tma, wsi, or "
+                             "the sources/cohorts in --manifests. In proportion to their number of patches if not "
+                             "set.")
+    parser.add_argument('--source_key', metavar='--sk', type=str, nargs='?', default="source",
+                        help="with --manifests, group train patches into sources by 'source' (ex: tma, wsi) or by "
+                             "'cohort'.")
+    parser.add_argument('--mining', metavar='--hm', type=int, nargs='?', default=0,
+                        help="draw train patches in proportion to their (moving average) dice loss, recorded while "
+                             "training. Not supported with --records or --loader.")
+    parser.add_argument('--mining_decay', metavar='--hmd', type=float, nargs='?', default=0.9,
+                        help="weight of the previous loss of a patch when its loss is recorded again.")
+    parser.add_argument('--mining_max_ratio', metavar='--hmr', type=float, nargs='?', default=4.,
+                        help="a patch is drawn at most this many times (and at least 1 / this) as often as "
+                             "uniformly.")
+    parser.add_argument('--tissue_power', metavar='--tp', type=float, nargs='?', default=0,
+                        help="draw train patches with probability proportional to their tissue fraction to this power "
+                             "(from --manifests). 0 draws patches uniformly.")
+    parser.add_argument('--min_tissue', metavar='--mt', type=float, nargs='?', default=0,
+                        help="never draw train patches with a smaller tissue fraction (from --manifests).")
+    parser.add_argument('--label_power', metavar='--lp', type=float, nargs='?', default=0,
+                        help="draw train patches with probability proportional to their fraction of epithelium pixels "
+                             "to this power (from --manifests). 0 ignores the class pixels.")
+    parser.add_argument('--strategy', metavar='--str', type=str, nargs='?', default="none", choices=STRATEGIES,
+                        help="data-parallel training: 'mirrored' over the GPUs in --gpu (ex: --gpu 0,1), "
+                             "'multi_worker' over the worker processes in TF_CONFIG (see launch_workers.py). "
+                             "--batch_size is then the global batch size, split between the replicas.")
+    parser.add_argument('--cpu_replicas', metavar='--cr', type=int, nargs='?', default=0,
+                        help="split the CPU into this many devices for --strategy mirrored, to test data-parallel "
+                             "training without GPUs. 0 does not split the CPU.")
+    parser.add_argument('--xla', metavar='--xla', type=int, nargs='?', default=0,
+                        help="compile the train step with XLA (see benchmark_model.py for its effect on step time "
+                             "and memory). Only supported with --network agunet.")
+    parser.add_argument('--schedule', metavar='--sch', type=str, nargs='*', default=[],
+                        help="progressive resolution schedule: phases as size:batch_size:epochs, trained on random "
+                             "crops (val on center crops) before the last epochs on full 1024x1024 patches with "
+                             "--batch_size, ex: 256:64:100 512:16:100. Counted in --epochs.")
+    parser.add_argument('--checkpointing', metavar='--ckpt', type=int, nargs='?', default=0,
+                        help="recompute the activations of the AGU-Net encoder/decoder blocks in the backward pass "
+                             "instead of storing them (gradient checkpointing), for larger batches at the cost of an "
+                             "extra forward pass. See benchmark_model.py. Not supported with --dropout.")
+    return parser
+
+
+if __name__ == "__main__":
+
+    ret = get_parser().parse_known_args(sys.argv[1:])[0]
 
     print(ret)
 
@@ -310,6 +856,9 @@ if __name__ == "__main__":
     # choose which GPU to use
     os.environ["CUDA_VISIBLE_DEVICES"] = ret.gpu
 
+    if ret.cpu_replicas:
+        split_cpu(ret.cpu_replicas)
+
     if ret.seed:
         os.environ["PYTHONHASHSEED"] = str(ret.seed)
         np.random.seed(ret.seed)
@@ -321,8 +870,8 @@ if __name__ == "__main__":
         #    print(e)
 
 
-    if ret.mixed_precision:
-        mixed_precision.set_global_policy('mixed_float16')
+    if precision_policy(ret) != "float32":
+        mixed_precision.set_global_policy(precision_policy(ret))
 
     main(ret)
 